@@ -1,8 +1,17 @@
-import json, asyncio, os, aiofiles
+import asyncio, os, re
+from collections import deque
+import orjson
 from pathlib import Path
-from codebase_qna.async_executors.dataset_stages import generate_qna, generate_rubric
+from codebase_qna.async_executors.dataset_stages import pipeline
 from utils.codebase_utils import WorktreeManager
+from utils.async_utils import install_uvloop, run_bounded
+from utils.rate_limit import TokenBucketLimiter, RateLimitCallback
+from utils.json_repair import JSONRepairAgent
+from utils.response_cache import ResponseCache
+from utils.jsonl_utils import JsonlWriter, load_jsonl, aiter_jsonl, iter_jsonl_lines, pr_number_of, drop_prs_from_jsonl
 from langchain_anthropic import ChatAnthropic
+from langchain_community.cache import SQLiteCache
+from langchain.agents import create_tool_calling_agent
 from dotenv import load_dotenv
 from codebase_qna.construct.construct_qna import Question, Answer
 from codebase_qna.construct.construct_rubric import Rubric
@@ -15,71 +24,68 @@ from langchain_core.output_parsers import PydanticOutputParser
 from typing import List
 import sys
 
-STAGES = [generate_qna, generate_rubric]
+ERROR_LOG_MAX = 32   # newest error entries kept per PR; each record embeds the whole log
+
+# Cheap pre-screen for failure markers on raw lines; hits are confirmed field-by-field below
+FAIL_RE = re.compile(rb"failed to generate|worktree creation failed", re.IGNORECASE)
+
+# case-insensitive field checks, so no .lower() copy of multi-KB answers
+FAIL_TEXT_RE = re.compile(r"failed to generate|worktree creation failed", re.IGNORECASE)
+FAIL_QUESTION_RE = re.compile(r"failed to generate question", re.IGNORECASE)
+
+def qna_failed(data: dict) -> bool:
+    return bool(FAIL_TEXT_RE.search(data.get("answer") or "")
+                or FAIL_QUESTION_RE.search(str(data.get('question'))))
+
+def rubric_failed(data: dict) -> bool:
+    return bool(FAIL_TEXT_RE.search(str(data.get('rubric'))))
+
+def classify_resume_file(path, is_failed) -> tuple[set, set, int]:
+    """
+    Pass 1 over an existing qna/rubric file: (seen, failed) pr_number sets plus the line count.
+    A case-insensitive regex pre-screens each raw line; only suspected failures pay
+    for a full parse and the exact per-field check.
+    """
+    seen, failed, n_lines = set(), set(), 0
+    if os.path.exists(path):
+        for line in iter_jsonl_lines(path):
+            n_lines += 1
+            pr_number = pr_number_of(line)
+            if FAIL_RE.search(line) and is_failed(orjson.loads(line)):
+                failed.add(pr_number)
+            else:
+                seen.add(pr_number)
+    return seen, failed, n_lines
+
 
 async def filter_and_clean_prs(merged_prs_path, qna_path, rubric_path):
-    qna_seen = set()
-    rubric_seen = set()
-    failed = set()
-    qna_lines = []
-    rubric_lines = []
     to_run = []
 
-    # Load existing QnA
-    if os.path.exists(qna_path):
-        async with aiofiles.open(qna_path) as f:
-            async for line in f:
-                data = json.loads(line)
-                pr_number = data.get("pr_number")
-                question = str(data.get('question')).lower()
-                answer = data.get("answer", "").lower()
-                if "failed to generate" in answer:
-                    failed.add(pr_number)
-                elif "worktree creation failed" in answer:
-                    failed.add(pr_number)
-                elif "failed to generate question" in question:
-                    failed.add(pr_number)
-                else:
-                    qna_seen.add(pr_number)
-                qna_lines.append(data)
-
-    # Load existing Rubrics
-    if os.path.exists(rubric_path):
-        async with aiofiles.open(rubric_path) as f:
-            async for line in f:
-                data = json.loads(line)
-                pr_number = data.get("pr_number")
-                rubric = str(data.get('rubric')).lower()
-                if "failed to generate" in rubric or "worktree creation failed" in rubric:
-                    failed.add(pr_number)
-                else:
-                    rubric_seen.add(pr_number)
-                rubric_lines.append(data)
-
-    print(f"Failed Rubrics: {len(rubric_lines) - len(rubric_seen)}")
-    print(f"Failed QnAs: {len(qna_lines) - len(qna_seen)}")
-
-
-    # Read merged PRs and filter
-    async with aiofiles.open(merged_prs_path) as f:
-        async for line in f:
-            pr = json.loads(line.strip())
-            pr_number = pr["pr_number"]
-            if pr_number not in qna_seen or pr_number not in rubric_seen or pr_number in failed:
-                to_run.append(pr)
+    # Pass 1: only pr_number sets are kept in memory, never the records themselves.
+    # The three files are independent, so scan them concurrently on the thread pool.
+    (qna_seen, qna_failed_prs, n_qna), (rubric_seen, rubric_failed_prs, n_rubric), merged_prs = await asyncio.gather(
+        asyncio.to_thread(classify_resume_file, qna_path, qna_failed),
+        asyncio.to_thread(classify_resume_file, rubric_path, rubric_failed),
+        asyncio.to_thread(load_jsonl, merged_prs_path),
+    )
+    failed = qna_failed_prs | rubric_failed_prs
+
+    print(f"Failed Rubrics: {n_rubric - len(rubric_seen)}")
+    print(f"Failed QnAs: {n_qna - len(qna_seen)}")
+
+
+    # Filter merged PRs
+    for pr in merged_prs:
+        pr_number = pr["pr_number"]
+        if pr_number not in qna_seen or pr_number not in rubric_seen or pr_number in failed:
+            to_run.append(pr)
 
     # Remove entries for failed/incomplete PRs
     remaining_prs = {pr["pr_number"] for pr in to_run}
 
-    async with aiofiles.open(qna_path, "w") as f:
-        for item in qna_lines:
-            if item["pr_number"] not in remaining_prs:
-                await f.write(json.dumps(item) + "\n")
-
-    async with aiofiles.open(rubric_path, "w") as f:
-        for item in rubric_lines:
-            if item["pr_number"] not in remaining_prs:
-                await f.write(json.dumps(item) + "\n")
+    # Pass 2: stream surviving raw lines into a temp file, then atomically swap it in
+    for path in (qna_path, rubric_path):
+        await asyncio.to_thread(drop_prs_from_jsonl, path, remaining_prs)
 
     
     print(f"Remaining PRs: {len(remaining_prs)} | To Run: {len(to_run)}")
@@ -90,66 +96,72 @@ async def filter_and_clean_prs(merged_prs_path, qna_path, rubric_path):
     return to_run
 
 
+def open_writers(cfg):
+    """One long-lived writer thread per output file; stages just `put` serialised lines."""
+    cfg["qna_writer"] = JsonlWriter(cfg["qna_path"])
+    cfg["rubric_writer"] = JsonlWriter(cfg["rubric_path"])
+
+
 async def worker(pr, cfg, sem):
     async with sem:
         ctx = {
             "pr": pr,
-            "error_log": [],
+            "error_log": deque(maxlen=ERROR_LOG_MAX),
             **cfg,
         }
-        # create & tear down worktree per PR
+        # create & tear down worktree per PR; once acquired, every exit path releases it
+        commit = pr["base_commit"]
+        acquired = False
         try:
-            commit = pr["base_commit"]
-            wt_path = await cfg["worktree"].acquire(commit)
-            ctx["codebase_files"] = cfg["worktree"].get_worktree_file_hierarchy(commit, max_depth = 3)
+            try:
+                wt_path = await cfg["worktree"].acquire(commit)
+                acquired = True
+                ctx["codebase_files"] = cfg["worktree"].get_worktree_file_hierarchy(commit, max_depth = 3)
 
-            ctx["tools"] = cfg["tool_factory"](str(wt_path), pr)
+                ctx["tools"] = cfg["tool_factory"](str(wt_path), pr)
         
-        except Exception as e:
-            print(f"Error creating worktree: {e}")
-            ctx["error_log"].append(
-                {"stage": "create_worktree", "pr_number": pr["pr_number"], "error": str(e)}
-            )
-            async with aiofiles.open(ctx["qna_path"], "a") as f:
-                await f.write(
-                    json.dumps(
+            except Exception as e:
+                print(f"Error creating worktree: {e}")
+                ctx["error_log"].append(
+                    {"stage": "create_worktree", "pr_number": pr["pr_number"], "error": str(e)}
+                )
+                ctx["qna_writer"].put(
+                    orjson.dumps(
                         {
                             "pr_number": ctx["pr"]["pr_number"],
                             "commit_hash": ctx["pr"]["base_commit"],
                             "question": "Failed to generate question: Worktree creation failed",
                             "answer": "Failed to generate answer: Worktree creation failed",
                             "sources": "Failed to generate sources: Worktree creation failed",
-                            "errors": ctx["error_log"],
+                            "errors": list(ctx["error_log"]),
                         }
                     )
-                    + "\n"
+                    + b"\n"
                 )
-            async with aiofiles.open(ctx["rubric_path"], "a") as f:
-                await f.write(
-                    json.dumps(
+                ctx["rubric_writer"].put(
+                    orjson.dumps(
                         {
                             "pr_number": ctx["pr"]["pr_number"],
                             "rubric": "Worktree creation failed",
-                            "errors": ctx["error_log"],
+                            "errors": list(ctx["error_log"]),
                         }
                     )
-                    + "\n"
+                    + b"\n"
                 )
 
-            return ctx
-
-        for stage in STAGES:
-            ctx = await stage(ctx)
+                return ctx
+
+            ctx = await pipeline(ctx)
+        finally:    # a raising tool setup or stage must still drop its reference, or the checkout is never evicted
+            if acquired:
+                try:
+                    await cfg["worktree"].release(commit)   # cleanup
+                except Exception as e:
+                    print(f"Error cleaning up worktree in {pr['pr_number']}: {e}")
+                    ctx["error_log"].append(
+                        {"stage": "create_worktree", "pr_number": pr["pr_number"], "error": str(e)}
+                    )
 
-        try:
-            await cfg["worktree"].release(commit)   # cleanup
-        except Exception as e:
-            print(f"Error cleaning up worktree in {pr['pr_number']}: {ctx['error_log']}")
-            ctx["error_log"].append(
-                {"stage": "create_worktree", "pr_number": pr["pr_number"], "error": str(e)}
-            )
-            return ctx
-        
         return ctx
 
 
@@ -161,11 +173,21 @@ async def main(args):
     max_concurrency = args.max_concurrency
 
     load_dotenv()
+    # pace requests against the account's RPM/TPM instead of backing off after 429s
+    callbacks = []
+    if args.requests_per_min or args.tokens_per_min:
+        limiter = TokenBucketLimiter(args.requests_per_min, args.tokens_per_min)
+        callbacks.append(RateLimitCallback(limiter))
+
     llm = ChatAnthropic(
         api_key=os.getenv("ANTHROPIC_API_KEY"),
         model_name=args.model,
         timeout=None,
-        stop=None
+        stop=None,
+        callbacks=callbacks,
+        # on-disk cache keyed by (prompt, model + bound tools); only when asked for, since
+        # --resume re-runs failed PRs and a cache would replay the same failing outputs
+        cache=SQLiteCache(database_path=args.llm_cache) if args.llm_cache else None,
     )
 
     if os.path.exists('worktrees'):
@@ -179,8 +201,20 @@ async def main(args):
     qna_path    = log_dir / "qna.jsonl"
     rubric_path = log_dir / "rubrics.jsonl"
 
+    tool_factory = lambda wt, pr: [
+        create_list_files_tool(wt),
+        create_read_file_tool(wt),
+        create_read_diff_tool(pr)
+    ]
+    # Tool names/descriptions are the same for every PR, so bind them into the agent
+    # runnables once; each PR only gets a fresh AgentExecutor over its own worktree tools.
+    schema_tools = tool_factory(".", {"diff": ""})
+
     cfg = dict(
         llm=llm,
+        question_agent=create_tool_calling_agent(llm, schema_tools, prompt=question_prompt),
+        answer_agent=create_tool_calling_agent(llm, schema_tools, prompt=answer_prompt),
+        rubric_agent=create_tool_calling_agent(llm, schema_tools, prompt=rubric_prompt),
         worktree=WorktreeManager(repo_path, task = "dataset_pipeline"),
         question_prompt=question_prompt,
         answer_prompt=answer_prompt,
@@ -191,13 +225,13 @@ async def main(args):
         QuestionModel=Question,
         AnswerModel=Answer,
         RubricModel=Rubric,
+        # finished rubrics by (model, commit, question, answer, sources); unset = no cache
+        rubric_cache=ResponseCache(args.rubric_cache) if args.rubric_cache else None,
+        json_repair=JSONRepairAgent(model_name="gpt-4.1-mini"),   # one per run, shared by every PR
         qna_path=str(qna_path),
         rubric_path=str(rubric_path),
-        tool_factory=lambda wt, pr: [
-            create_list_files_tool(wt),
-            create_read_file_tool(wt),
-            create_read_diff_tool(pr)
-        ],
+        tool_factory=tool_factory,
+        verbose=args.verbose,
     )
 
     sem = asyncio.Semaphore(max_concurrency)
@@ -214,28 +248,25 @@ async def main(args):
             sys.exit(0)
         if args.num_to_run:
             prs_to_run = prs_to_run[:args.num_to_run]
-        tasks = [asyncio.create_task(worker(pr, cfg, sem)) for pr in prs_to_run]
+        # group same-commit PRs so they overlap in time and share (or reuse) one worktree
+        prs_to_run.sort(key=lambda pr: pr["base_commit"])
     else:
         if os.path.exists(qna_path) or os.path.exists(rubric_path):
             print("QnA or Rubric files found, run with --resume to continue")
             sys.exit(0)
 
-        tasks = []
-        async with aiofiles.open(merged_prs_path) as f:
-            if args.num_to_run:
-                for i in range(args.num_to_run):
-                    line = await f.readline()
-                    if not line:
-                        break
-                    pr = json.loads(line.strip())
-                    tasks.append(asyncio.create_task(worker(pr, cfg, sem)))
-
-            else:
-                async for line in f:
-                    pr = json.loads(line.strip())
-                    tasks.append(asyncio.create_task(worker(pr, cfg, sem)))
+        # stream straight into the workers: constant memory, first PR starts immediately
+        prs_to_run = aiter_jsonl(merged_prs_path, limit=args.num_to_run)
 
-    await asyncio.gather(*tasks)
+    open_writers(cfg)
+    try:
+        await run_bounded(lambda pr: worker(pr, cfg, sem), prs_to_run, max_pending=max_concurrency * 2)
+    finally:
+        await cfg["worktree"].close()
+        for writer in (cfg["qna_writer"], cfg["rubric_writer"]):
+            await asyncio.to_thread(writer.close)
+        if cfg["rubric_cache"] is not None:
+            cfg["rubric_cache"].close()     # commits the last batch of cached rubrics
 
 if __name__ == "__main__":
     import argparse, asyncio
@@ -247,7 +278,18 @@ if __name__ == "__main__":
     p.add_argument("--num_to_run", type=int, default=None)
     p.add_argument("--max_concurrency", type=int, default=10)
     p.add_argument("--model", required=True)
+    p.add_argument("--llm_cache", default=None,
+                   help="path to a SQLite cache of LLM responses (e.g. .llm_cache.sqlite); unset = no cache")
+    p.add_argument("--verbose", action="store_true",
+                   help="print every agent step (interleaves across concurrent PRs)")
+    p.add_argument("--rubric_cache", default=None,
+                   help="sqlite file caching finished rubrics across runs (e.g. .rubric_cache.sqlite); unset = no cache")
+    p.add_argument("--requests_per_min", type=float, default=None,
+                   help="proactive LLM request budget (unset = unlimited)")
+    p.add_argument("--tokens_per_min", type=float, default=None,
+                   help="proactive estimated input-token budget (unset = unlimited)")
     args = p.parse_args()
+    install_uvloop()                    # optional; falls back to the default loop
     asyncio.run(main(args))
 
 
@@ -1,11 +1,10 @@
-import asyncio, json, os, time, traceback, threading
+import asyncio, os
+import orjson
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import pandas as pd
-from typing import Dict, Any, List, Callable, Set
-import aiofiles
+from typing import Dict, Any, List, Callable
 import re
-import shutil
-import tempfile
 
 from dotenv import load_dotenv
 from langchain_anthropic import ChatAnthropic
@@ -18,49 +17,45 @@ from langchain_core.tools import Tool
 from pydantic import BaseModel, Field
 from langchain_core.output_parsers import PydanticOutputParser
 from codebase_qna.evaluate.grade_answer import CriterionGrade, GradedRubric
-from langchain_core.messages import SystemMessage
+from langchain_core.messages import SystemMessage, AIMessage
 from langchain_core.prompts import ChatPromptTemplate
 from codebase_qna.prompt_templates.prompts import GRADE_SYSTEM_PROMPT_DEEPWIKI
 
 grade_rubric_parser = PydanticOutputParser(pydantic_object=GradedRubric)
 
+# static prefix (tool schemas + system prompt + format instructions) ends in an Anthropic
+# cache breakpoint, so rows graded within the cache TTL read it from the prompt cache
 grade_rubric_prompt = ChatPromptTemplate.from_messages([
     SystemMessage(GRADE_SYSTEM_PROMPT_DEEPWIKI),
-    ("assistant", "{format_instructions}"),
+    AIMessage([{"type": "text", "text": grade_rubric_parser.get_format_instructions(),
+                "cache_control": {"type": "ephemeral"}}]),
     ("placeholder", "{agent_scratchpad}"),
     ("user", "full_repo_path for DeepWiki Tools: {full_repo_name}"),
     ("user", "Rubric to apply: {rubric}"),
     ("user", "Question: {question}"),
     ("user", "Answer to grade: {answer}")
-]).partial(
-    format_instructions=grade_rubric_parser.get_format_instructions()
-)
+])
 
-from utils.json_repair import JSONRepairAgent, ClaudeJSONRepairAgent       # helper for invalid JSON\
+from utils.json_repair import JSONRepairAgent, ClaudeJSONRepairAgent, fast_repair_json       # helper for invalid JSON\
 from utils.codebase_utils import WorktreeManager
+from utils.async_utils import retry_with_backoff, run_bounded, install_uvloop
+from utils.rate_limit import RateLimitGate, RateLimitCallback
+from utils.grading_utils import dump_line, log_err, grade_inputs, format_grades, filter_and_clean_graded_rubrics, set_err_file
+from utils.jsonl_utils import JsonlWriter, index_jsonl
+from utils.response_cache import cache_key
 from langchain_mcp_adapters.client import MultiServerMCPClient
 
 json_repair_agent = ClaudeJSONRepairAgent()
 
-ERR_FILE = Path("logs/grade_agent_answer_errors.log")
+# one cooldown shared by every grade_worker: a 429 pauses all requests, not just the one that hit it
+rate_limit_gate = RateLimitGate()
 
 MAX_PARALLEL = 10
-
-_lock = threading.Lock()
-def log_err(msg: str, exc: Exception | None = None):
-    with _lock, ERR_FILE.open("a") as fh:
-        fh.write(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {msg}\n")
-        if exc:
-            fh.write("".join(traceback.format_exception(exc)))
-        fh.write("-"*60 + "\n")
-
-
-
-def display_markdown(df):
-    print(df.to_markdown(index=False))
-
-def dataframe_from_grades(gr: GradedRubric) -> pd.DataFrame:
-    return pd.DataFrame([g.model_dump() for g in gr.graded_criteria])
+GRADE_MAX_TOKENS = 4096         # a graded rubric is one JSON object with short justifications
+LLM_TIMEOUT = 120               # seconds per model call
+AGENT_MAX_ITERATIONS = 15       # tool-calling steps per row
+AGENT_MAX_SECONDS = 300         # wall-clock budget per row
+VERBOSE = False         # --verbose: print each row's per-criterion scores
 
 # -------------------------------- Tools for Grading ------------------------------------- #
 
@@ -131,52 +126,17 @@ def create_get_diff_tool(row: Dict[str, str]):
     )
 
 
+def grading_tools(worktree_path: str, row: Dict[str, str], mcp_tools: List[Tool]) -> List[Tool]:
+    return mcp_tools + [create_file_exists_tool(worktree_path),
+                        create_read_file_tool(worktree_path),
+                        create_list_changed_files_tool(row),
+                        create_get_diff_tool(row)]
+
+
 # -------------------------------- Main Functions ------------------------------------- #
 
-async def filter_and_clean_graded_rubrics(
-    answer_path: Path, output_path: Path, cleaned_path: Path
-) -> Set[str]:
-    """
-    Create a cleaned output by filtering out failed graded rubrics.
-    Merges with previously successful entries in `cleaned_path` if it exists.
-    """
-    failed_pr_numbers = set()
-    seen_prs = set()
-    entries_to_keep = {}
-
-    # Load new graded results and track failures
-    async with aiofiles.open(output_path, mode="r") as f:
-        async for line in f:
-            entry = json.loads(line)
-            pr = entry["pr_number"]
-            if entry.get("score_percent") == "Failed to grade":
-                failed_pr_numbers.add(pr)
-            else:
-                entries_to_keep[pr] = entry
-
-    # Merge in previously successful entries from cleaned_path if it exists
-    if cleaned_path.exists():
-        async with aiofiles.open(cleaned_path, mode="r") as f:
-            async for line in f:
-                entry = json.loads(line)
-                pr = entry["pr_number"]
-                if pr not in failed_pr_numbers:
-                    entries_to_keep[pr] = entry  # don't overwrite with failure
-
-    print(f"❌ Failed to grade: {len(failed_pr_numbers)} PRs")
-    print(f"✅ Total entries to keep: {len(entries_to_keep)}")
-
-    # Write to a temporary file to allow safe overwrite
-    with tempfile.NamedTemporaryFile("w", delete=False, dir=cleaned_path.parent, suffix=".jsonl") as tmp_f:
-        tmp_path = Path(tmp_f.name)
-
-    async with aiofiles.open(tmp_path, mode="w") as f:
-        for pr, entry in entries_to_keep.items():
-            await f.write(json.dumps(entry) + "\n")
-
-    shutil.move(tmp_path, cleaned_path)
-    print(f"✅ Cleaned file written to {cleaned_path}")
-    return failed_pr_numbers
+JSON_FENCE_RE = re.compile(r"```json\n(.*?)\n```", re.DOTALL)    # multi-line fenced block
+JSON_OBJECT_RE = re.compile(r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}')   # { ... } with one level of nesting
 
 async def parse_json_output_grade_rubric(
     text: str,
@@ -188,28 +148,41 @@ async def parse_json_output_grade_rubric(
     """Attempts multiple strategies to parse or repair a model-compatible JSON output."""
     raw = text.strip()
 
+    # plain JSON (the usual case): parse + validate in one pydantic-core pass,
+    # skipping the parser's markdown scan and stdlib json round-trip
+    try:
+        return schema.model_validate_json(raw)
+    except ValueError:
+        pass
+
     # Try parser with wrapped JSON
     try:
         return parser.parse(raw)
     except OutputParserException:
         pass
     
-    # regex extract json
-    try:
-        return parser.parse(re.search(r"```json\n(.*)\n```", raw).group(1))
-    except Exception:
-        pass
+    # regex extract json (only worth trying when there is a fence at all)
+    if "```" in raw:
+        try:
+            return parser.parse(JSON_FENCE_RE.search(raw).group(1))
+        except Exception:
+            pass
 
     # regex extract json by matching { ... }
     try:
-        # Use non-greedy match and handle nested braces
-        pattern = r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}'
-        match = re.search(pattern, raw)
+        match = JSON_OBJECT_RE.search(raw)
         if match:
             return parser.parse(match.group(0))
     except Exception:
         pass
 
+    # deterministic repair (string-aware brace scan + orjson) before paying for an LLM call
+    if (data := fast_repair_json(raw)) is not None:
+        try:
+            return schema.model_validate(data)
+        except Exception:
+            pass
+
     # Try repair with raw JSON
     try:
         return await repair_agent.repair_json_output(raw, schema)
@@ -224,104 +197,97 @@ async def parse_json_output_grade_rubric(
 
 async def grade_worker(
         row: Dict[str, str], 
-        sem: asyncio.Semaphore, 
-        llm: ChatAnthropic, 
+        agent,
         graded_rubric_parser: PydanticOutputParser, 
-        output_file: Path, 
+        writer: JsonlWriter, 
         worktree_manager: WorktreeManager,
         mcp_tools: List[Tool]
     ) -> Dict[str, Any] | None:
 
     """Grade one (question, answer, rubric) row.  Returns None on hard failure."""
 
-    async with sem:
-        try:
-            wt_path = await worktree_manager.acquire(row["commit_hash"])
-        except Exception as e:
-            print(f"Failed to create worktree for {row['commit_hash']}", e)
-            return None
-        
-        tools: List[Tool] = mcp_tools + [
-            create_file_exists_tool(str(wt_path)), 
-            create_read_file_tool(str(wt_path)),
-            create_list_changed_files_tool(row), 
-            create_get_diff_tool(row)
-        ]
-
-        agent = create_tool_calling_agent(llm, tools, prompt=grade_rubric_prompt)
-        executor = AgentExecutor(
-            agent=agent, 
-            tools=tools, 
-            verbose=True, 
-            max_iterations = None,
-            max_execution_time = 600,
-            early_stopping_method = "generate",
-            return_intermediate_steps=True
-        )
+    rubric_json = orjson.dumps(row["rubric"]).decode()
+    try:
+        wt_path = await worktree_manager.acquire(row["commit_hash"])
+    except Exception as e:
+        print(f"Failed to create worktree for {row['commit_hash']}", e)
+        log_err(f"PR {row['pr_number']}: worktree creation failed for {row['commit_hash']}", e)
+        return None
+    
+    tools = grading_tools(str(wt_path), row, mcp_tools)
+    executor = AgentExecutor(          # cheap wrapper; the agent runnable is shared
+        agent=agent, 
+        tools=tools, 
+        verbose=True, 
+        max_iterations = AGENT_MAX_ITERATIONS,
+        max_execution_time = AGENT_MAX_SECONDS,
+        early_stopping_method = "force",   # tool-calling agents only support "force"
+        return_intermediate_steps=True
+    )
 
-        tool_calls = []
-        graded: GradedRubric | None = None
+    tool_calls = []
+    graded: GradedRubric | None = None
 
-        try:
-            result = await executor.ainvoke(
+    try:
+        # transient API errors back off and re-run the agent; anything else fails the row
+        result = await retry_with_backoff(
+            lambda: executor.ainvoke(
                 {
-                "rubric":   json.dumps(row["rubric"]),
+                "rubric":   rubric_json,
                 "question": row["question"],
                 "answer":   row["answer"],
                 "full_repo_name": row["full_repo_name"]
                 },
                 return_intermediate=True
-            )
+            ),
+            rate_limit_gate.retryable,
+        )
 
-            intermediate_steps = result.get("intermediate_steps", [])
+        intermediate_steps = result.get("intermediate_steps", [])
 
-            for action, observation in intermediate_steps:
-                tool_calls.append({
-                    "tool": action.tool,
-                    "input": action.tool_input,
-                    "output": observation
-                })
-            
+        for action, observation in intermediate_steps:
+            tool_calls.append({
+                "tool": action.tool,
+                "input": action.tool_input,
+                "output": observation
+            })
+        
 
-            text = result["output"][0]["text"]
+        text = result["output"][0]["text"]
 
-            print("Final LLM output: \n ", text)
-        
+        print("Final LLM output: \n ", text)
+    
 
-            graded = await parse_json_output_grade_rubric(
-                text, GradedRubric, graded_rubric_parser, json_repair_agent,
-                default = None
-            )
-         
-        except Exception as e:
-            print(f"LLM retry failed for Q='{row['question'][:40]}…'", e)
-            print(traceback.format_exc())
-            result = {
-                "pr_number":     row["pr_number"],
-                "commit_hash":   row["commit_hash"],
-                "score_percent": "Failed to grade",
-                "graded_rubric": "Failed to grade",
-                "feedback":      "Failed to grade",
-                "tool_calls":    tool_calls,
-                "agent_answer":  row["answer"],
-                "question":      row["question"],
-                "rubric":        row["rubric"],   
-            }
-            async with aiofiles.open(output_file, 'a') as f:
-                await f.write(json.dumps(result) + "\n")
-                await f.flush()
-            try:
-                await worktree_manager.release(row["commit_hash"])
-            except Exception as e:
-                print(f"Failed to delete worktree for {row['commit_hash']}", e)
-            return result
-        
+        graded = await parse_json_output_grade_rubric(
+            text, GradedRubric, graded_rubric_parser, json_repair_agent,
+            default = None
+        )
+     
+    except Exception as e:
+        print(f"LLM retry failed for Q='{row['question'][:40]}…'", e)
+        log_err(f"PR {row['pr_number']}: grading failed for Q='{row['question'][:80]}'", e)
+        result = {
+            "pr_number":     row["pr_number"],
+            "commit_hash":   row["commit_hash"],
+            "score_percent": "Failed to grade",
+            "graded_rubric": "Failed to grade",
+            "feedback":      "Failed to grade",
+            "tool_calls":    tool_calls,
+            "agent_answer":  row["answer"],
+            "question":      row["question"],
+            "rubric":        row["rubric"],   
+        }
+        writer.put(dump_line(result))
+        return result
+
+    finally:    # failed rows must drop their reference too, or the worktree is never reused/evicted
         try:
             await worktree_manager.release(row["commit_hash"])
         except Exception as e:
             print(f"Failed to delete worktree for {row['commit_hash']}", e)
+            log_err(f"PR {row['pr_number']}: worktree release failed for {row['commit_hash']}", e)
+
 
-    
 
     # --- compute percentage score ---
     if graded is None:
@@ -339,7 +305,8 @@ async def grade_worker(
         pct     = round((total / maximum) * 100, 2) if maximum else 0.0
 
     # pretty-print to console (optional)
-    display_markdown(dataframe_from_grades(graded))
+    if VERBOSE:
+        print(format_grades(graded))
 
     result = {
         "pr_number":     row["pr_number"],
@@ -354,9 +321,7 @@ async def grade_worker(
     }
 
     # Write result immediately
-    async with aiofiles.open(output_file, 'a') as f:
-        await f.write(json.dumps(result) + "\n")
-        await f.flush()
+    writer.put(dump_line(result))
     print("✔︎ graded:", result["question"][:60])
 
     return result
@@ -376,12 +341,16 @@ async def run_parallel(
         full_repo_name: str 
     ):
 
-    global MAX_PARALLEL
-    sem = asyncio.Semaphore(MAX_PARALLEL)
+    # the agent only needs tool schemas (MCP tools included), which don't depend on the
+    # worktree or row, so the prompt | llm.bind_tools runnable is built once for the run
+    agent = create_tool_calling_agent(
+        llm, grading_tools(".", {"changed_files": [], "diff": ""}, mcp_tools), prompt=grade_rubric_prompt
+    )
 
-    a_dict = {obj["pr_number"]: obj for obj in map(json.loads, answer_path.read_text().splitlines())}
-    r_dict = {obj["pr_number"]: obj for obj in map(json.loads, rubric_path.read_text().splitlines())}
-    pr_dict = {obj["pr_number"]: obj for obj in map(json.loads, merged_prs_path.read_text().splitlines())}
+    a_dict = index_jsonl(answer_path)
+    r_dict = index_jsonl(rubric_path)
+    # merged PRs carry MB-scale diffs, so only the PRs that will actually be graded are kept
+    pr_dict = index_jsonl(merged_prs_path, keep=a_dict.keys() & r_dict.keys())
 
     shared = a_dict.keys() & r_dict.keys()
     rows = []
@@ -416,23 +385,53 @@ async def run_parallel(
         if not out_path.exists():
             print("Output file does not exist. Please run without --resume.")
             return
-        failed_pr_numbers = await filter_and_clean_graded_rubrics(answer_path, out_path, out_path)
+        failed_pr_numbers, _ = await filter_and_clean_graded_rubrics(out_path, out_path)
         rows = [row for row in rows if row["pr_number"] not in failed_pr_numbers]
 
     if num_to_grade:
         rows = rows[:num_to_grade]
 
-    tasks = [asyncio.create_task(grade_worker(row, sem, llm, graded_rubric_parser, out_path, worktree_manager, mcp_tools)) 
-             for row in rows]
+    # one writer thread batches finished rows instead of an open/append per row
+    writer = JsonlWriter(out_path)
+    # LangChain runs the sync Tool callables (file reads) on the default executor, which
+    # defaults to min(32, cpu_count + 4) threads; size it to the row concurrency instead
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=MAX_PARALLEL * 2))
+
+    # rows whose grading inputs are identical (same commit, diff, question, answer, rubric)
+    # are graded once and the result is copied to the other PRs
+    groups = defaultdict(list)
+    for row in rows:
+        groups[cache_key(*grade_inputs(row, orjson.dumps(row["rubric"]).decode()))].append(row)
+    if len(groups) < len(rows):
+        print(f"✅ {len(rows) - len(groups)} duplicate rows will reuse another PR's grade")
+
+    # same-commit groups back to back, so concurrent rows share one checkout in the
+    # WorktreeManager instead of interleaving commits and evicting idle worktrees
+    groups = sorted(groups.values(), key=lambda g: g[0]["commit_hash"])
+
+    # MAX_PARALLEL groups in flight at a time; tasks are created as slots free up, not all up front
+    num_graded = 0
+    async def grade(group):
+        nonlocal num_graded
+        result = await grade_worker(group[0], agent, graded_rubric_parser, writer, worktree_manager, mcp_tools)
+        if result is None:
+            return
+        for dup in group[1:]:
+            writer.put(dump_line({**result, "pr_number": dup["pr_number"]}))
+        num_graded += len(group)
 
-    results = await asyncio.gather(*tasks)
-    print(f"✅ Completed {sum(r is not None for r in results)} graded results → {out_path}")
+    try:
+        await run_bounded(grade, groups, max_pending=MAX_PARALLEL)
+    finally:
+        await worktree_manager.close()
+        await asyncio.to_thread(writer.close)   # drain queued rows even if a task raised
+    print(f"✅ Completed {num_graded} graded results → {out_path}")
 
 def main(args):
+    err_file = Path(args.output_path).with_suffix(".errors.log")
+    set_err_file(err_file)          # log_err appends next to this run's output
 
-    ERR_FILE = Path(args.output_path).with_suffix(".errors.log")
-
-    graded_rubric_parser = PydanticOutputParser(pydantic_object=GradedRubric)
+    graded_rubric_parser = grade_rubric_parser     # module-level parser; its schema/format instructions are already built
 
     worktree_manager = WorktreeManager(repo_path=args.repo_path, task="grading")
 
@@ -441,17 +440,20 @@ def main(args):
     llm = ChatAnthropic(
         model_name=args.model,
         api_key=os.getenv("ANTHROPIC_API_KEY"),
-        timeout=None,
+        timeout=LLM_TIMEOUT,
         stop=None,
-        max_tokens = 10000,
+        max_tokens = GRADE_MAX_TOKENS,
+        max_retries = 0,            # grade_worker's backoff loop owns the retry policy
+        callbacks = [RateLimitCallback(gate=rate_limit_gate)],
         # default_headers={
         #     "anthropic-beta": "output-128k-2025-02-19"
         # }
     )
 
     # set global variable for MAX_PARALLEL
-    global MAX_PARALLEL
+    global MAX_PARALLEL, VERBOSE
     MAX_PARALLEL = int(args.max_parallel)
+    VERBOSE = args.verbose
 
     # ---------------- DeepWiki MCP tools ------------------------ #
     async def get_mcp_tools() -> List[Tool]:
@@ -483,10 +485,11 @@ def main(args):
     ))
 
     print("✅ Graded rubrics written to", args.output_path)
-    print("⚠️ Any errors logged to", ERR_FILE)
+    print("⚠️ Any errors logged to", err_file)
 
 if __name__ == "__main__":
     import argparse
+    install_uvloop()                    # optional; falls back to the default loop
     p = argparse.ArgumentParser()
     p.add_argument("--repo_path",     required=True, type=Path)
     p.add_argument("--full_repo_name", required=True, type=str)
@@ -498,6 +501,7 @@ if __name__ == "__main__":
     p.add_argument("--num_to_grade",  required=False, default=None, type=int)
     p.add_argument("--model",        required=False, default="claude-3-5-sonnet-20240620")
     p.add_argument("--max_parallel", required=False, default=10)
+    p.add_argument("--verbose",      required=False, action="store_true", default=False)
     args = p.parse_args()
     main(args)
 
@@ -0,0 +1,310 @@
+"""
+Shared machinery for the Claude Code answer pipelines: subprocess/API calls,
+per-commit work-tree groups, the worker pool, resume handling and the JSONL writer.
+Entrypoints supply `build_prompt(item) -> str` and `load_groups(args, skip)` yielding
+(commit_hash, items) groups.
+"""
+import asyncio, os, argparse
+import orjson
+import httpx
+from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient
+from functools import cache
+from typing import Callable, Iterable
+from pathlib import Path
+from dotenv import load_dotenv
+from utils.codebase_utils import WorktreeManager          # your helper
+from codebase_qna.prompt_templates.prompts import ANSWER_SYSTEM_PROMPT  # your prompt
+from utils.jsonl_utils import JsonlWriter, scan_answered_prs
+from utils.async_utils import gather_fail_fast, AdmissionController
+from utils.response_cache import ResponseCache, cache_key
+
+MAX_CONCURRENCY = 10
+STDOUT_CHUNK_SIZE = 1 << 16
+API_MAX_TOKENS = 8192
+MAX_ATTEMPTS = 3
+
+# Invariant across questions, so built once rather than per run_question call
+PROMPT_PREFIX = (
+    f"{ANSWER_SYSTEM_PROMPT}\n"
+    "Also for the purposes of the question, answer as thoroughly as possible "
+    "and try to think of the true intent of the question. Therefore refrain "
+    "from asking too many clarifications. The junior is trying to figure out "
+    "how to implement or fix something. Therefore answer as thoroughly as possible.\n\n"
+)
+
+# ---------- subprocess output -----------------------------------------------
+async def read_output(stream: asyncio.StreamReader, commit_hash: str) -> str:
+    """Drain `stream` in 64KB chunks, echoing each chunk with the commit prefix."""
+    chunks: list[bytes] = []
+    while chunk := await stream.read(STDOUT_CHUNK_SIZE):
+        print(f"[{commit_hash}] {chunk.decode(errors='replace')}", end="")  # live echo
+        chunks.append(chunk)
+    return b"".join(chunks).decode()
+
+async def echo_stderr(stream: asyncio.StreamReader, commit_hash: str):
+    """Echo diagnostics without letting them leak into the captured answer."""
+    while chunk := await stream.read(STDOUT_CHUNK_SIZE):
+        print(f"[{commit_hash}] stderr: {chunk.decode(errors='replace')}", end="")
+
+# ---------- Claude Code subprocess ------------------------------------------
+def claude_argv_tail(wt_path: Path, args: argparse.Namespace) -> tuple[str, ...]:
+    """argv after the prompt; fixed per work-tree, so built once per commit group."""
+    return ("--model", args.model, "--allowedTools", f"Read({wt_path})")
+
+async def run_claude_once(full_prompt: str, argv_tail: tuple[str, ...],
+                          commit_hash: str) -> str:
+    """Single `claude -p` invocation; returns stripped stdout."""
+    proc = await asyncio.create_subprocess_exec(
+        "claude", "-p", full_prompt, *argv_tail,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+    try:
+        output, _, _ = await asyncio.gather(
+            read_output(proc.stdout, commit_hash),
+            echo_stderr(proc.stderr, commit_hash),
+            proc.wait(),
+        )
+    except asyncio.CancelledError:
+        # stop the child now rather than letting Claude finish in the background
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    return output.strip()
+
+async def run_claude(full_prompt: str, argv_tail: tuple[str, ...], commit_hash: str) -> str:
+    """Run Claude Code (read access set in `argv_tail`), retrying on (no content) with backoff."""
+    for attempt in range(MAX_ATTEMPTS):
+        print(f"[{commit_hash}] running Claude Code …")
+        response = await run_claude_once(full_prompt, argv_tail, commit_hash)
+        if response != "(no content)":
+            return response
+        if attempt < MAX_ATTEMPTS - 1:  # no point sleeping after the last try
+            print(f"[{commit_hash}] Claude Code returned (no content), retrying in {2 ** attempt}s...")
+            await asyncio.sleep(2 ** attempt)
+
+    print(f"[{commit_hash}] Claude Code has failed {MAX_ATTEMPTS} times, skipping...")
+    return "(no content)"
+
+# ---------- Anthropic API (shared client) ------------------------------------
+@cache
+def get_api_client(max_concurrency: int) -> AsyncAnthropic:
+    """One pooled client per run, so connections/TLS sessions are reused across questions."""
+    return AsyncAnthropic(
+        max_retries=3,
+        http_client=DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_connections=max_concurrency * 2,
+                                max_keepalive_connections=max_concurrency * 2),
+            timeout=None,
+        ),
+    )
+
+async def run_claude_api(full_prompt: str, commit_hash: str,
+                         args: argparse.Namespace) -> str:
+    """
+    Answer via the Messages API instead of spawning the CLI.
+    No Read tool here, so the model only sees the prompt, not the work-tree.
+    """
+    print(f"[{commit_hash}] calling Anthropic API …")
+    client = get_api_client(args.max_concurrency)
+    async with client.messages.stream(
+        model=args.model,
+        max_tokens=API_MAX_TOKENS,
+        messages=[{"role": "user", "content": full_prompt}],
+    ) as stream:
+        response = (await stream.get_final_text()).strip()
+    return response or "(no content)"
+
+# ---------- answer cache -----------------------------------------------------
+def answer_key(item: dict, full_prompt: str, args: argparse.Namespace) -> str:
+    """Everything that decides an answer: backend, model, commit and the full prompt."""
+    return cache_key(args.backend, args.model, item["commit_hash"], full_prompt)
+
+
+def write_answer(item: dict, response: str, writer: JsonlWriter) -> dict:
+    """Hand one answer record to the writer thread."""
+    result = {
+        "pr_number": item["pr_number"],
+        "commit_hash": item["commit_hash"],
+        "question": item["question"],
+        "answer": response
+    }
+    writer.put(orjson.dumps(result) + b"\n")
+    print(f"✅ queued answer for {item['commit_hash']}")
+    return result
+
+
+# ---------- per-question coroutine ------------------------------------------
+async def run_question(item: dict, full_prompt: str, argv_tail: tuple[str, ...] | None,
+                       controller: AdmissionController, writer: JsonlWriter, args: argparse.Namespace,
+                       cache: ResponseCache | None = None, key: str | None = None) -> dict | None:
+    """
+    Answer one {commit_hash, question} record against an already-acquired work-tree.
+    `full_prompt` and its cache `key` come from run_group, so each is built once.
+    """
+    commit_hash = item["commit_hash"]
+
+    # 1) fire off Claude Code
+    async with controller:              # limit concurrent Claude subprocesses
+        if args.backend == "api":
+            response = await run_claude_api(full_prompt, commit_hash, args)
+        else:
+            response = await run_claude(full_prompt, argv_tail, commit_hash)
+
+    if cache is not None and response != "(no content)":   # failures stay uncached, so --resume retries them
+        cache.set(key, {"answer": response})
+
+    # 2) hand result to the writer thread
+    return write_answer(item, response, writer)
+
+
+# ---------- per-commit group -------------------------------------------------
+async def run_group(commit_hash: str, items: list[dict], manager: WorktreeManager,
+                    build_prompt: Callable[[dict], str],
+                    controller: AdmissionController, writer: JsonlWriter,
+                    args: argparse.Namespace, cache: ResponseCache | None = None) -> list[dict | None]:
+    """Acquire the work-tree for `commit_hash` once and answer every question on it."""
+    # (item, prompt, cache key): the prompt is built and hashed once per question
+    todo = [(item, build_prompt(item), None) for item in items]
+    cached: list[dict | None] = []
+    if cache is not None:               # cached answers skip Claude and, if all hit, the work-tree
+        misses = []
+        for item, full_prompt, _ in todo:
+            key = answer_key(item, full_prompt, args)
+            if (hit := cache.get(key)) is not None:
+                print(f"⚡ cache hit: {item['question'][:60]}")
+                cached.append(write_answer(item, hit["answer"], writer))
+            else:
+                misses.append((item, full_prompt, key))
+        todo = misses
+        if not todo:
+            return cached
+
+    if args.backend == "api":           # API backend never reads the work-tree
+        return cached + await gather_fail_fast(
+            *(run_question(item, full_prompt, None, controller, writer, args, cache, key)
+              for item, full_prompt, key in todo)
+        )
+
+    try:
+        wt_path = await manager.acquire(commit_hash)
+    except Exception as e:
+        print(f"[{commit_hash}] work-tree error → {e}")
+        return cached + [None] * len(todo)
+
+    argv_tail = claude_argv_tail(wt_path, args)
+    try:
+        return cached + await gather_fail_fast(
+            *(run_question(item, full_prompt, argv_tail, controller, writer, args, cache, key)
+              for item, full_prompt, key in todo)
+        )
+    finally:
+        try:
+            await manager.release(commit_hash)
+        except Exception as e:
+            print(f"[{commit_hash}] cleanup error → {e}")
+
+
+# ---------- worker pool ------------------------------------------------------
+async def feed_groups(queue: asyncio.Queue, groups: Iterable[tuple[str, list[dict]]],
+                      num_workers: int):
+    """Push (commit_hash, items) groups onto `queue`, then one None per worker."""
+    for group in groups:
+        await queue.put(group)
+    for _ in range(num_workers):
+        await queue.put(None)
+
+
+async def worker(queue: asyncio.Queue, manager: WorktreeManager,
+                 build_prompt: Callable[[dict], str], controller: AdmissionController,
+                 writer: JsonlWriter, args: argparse.Namespace, results: list,
+                 cache: ResponseCache | None = None):
+    """Pull (commit_hash, questions) groups off `queue` until a None sentinel arrives."""
+    while (group := await queue.get()) is not None:
+        commit_hash, items = group
+        try:
+            results.extend(await run_group(commit_hash, items, manager, build_prompt,
+                                           controller, writer, args, cache))
+        except Exception as e:
+            print(f"[{commit_hash}] failed → {e}")
+            results.extend([None] * len(items))
+
+
+# ---------- async driver -----------------------------------------------------
+async def run(build_prompt: Callable[[dict], str],
+              load_groups: Callable[[argparse.Namespace, set], Iterable[tuple[str, list[dict]]]],
+              args: argparse.Namespace):
+    """
+    Resume/overwrite handling, then answer every group yielded by `load_groups(args, skip)`
+    where `skip` holds the PR numbers already answered.
+    """
+    load_dotenv()
+
+    questions_path = Path(args.questions_file)
+    output_path = Path(
+        args.output_file or questions_path.parent / "claude_code_answers.jsonl"
+    )
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    pr_numbers_already_ran: set = set()
+
+    if args.resume:
+        if output_path.exists():
+            pr_numbers_already_ran = scan_answered_prs(output_path)
+            print(f"✅ Found {len(pr_numbers_already_ran)} Questions Already Answered")
+        else:
+            print("Output file does not exist. Please run without --resume.")
+            return
+    else:
+        if output_path.exists():
+            # Ask user for permission to overwrite
+            overwrite = input(f"Output file {output_path} already exists. Do you want to overwrite it? (y/n): ")
+            if overwrite.lower() != "y":
+                print("Exiting...")
+                return
+            else:
+                output_path.unlink()
+
+    groups = load_groups(args, pr_numbers_already_ran)
+
+    manager    = WorktreeManager(args.repo_path, task = "claude_qna")
+    writer     = JsonlWriter(output_path)
+    controller = AdmissionController(args.max_concurrency)
+    queue      = asyncio.Queue(maxsize=args.max_concurrency * 2)
+    # exact-match cache of finished answers; a re-run of the same questions skips Claude
+    cache      = ResponseCache(args.answer_cache) if args.answer_cache else None
+
+    results: list[dict | None] = []
+    workers = [asyncio.create_task(worker(queue, manager, build_prompt, controller,
+                                          writer, args, results, cache))
+               for _ in range(args.max_concurrency)]
+    try:
+        await feed_groups(queue, groups, args.max_concurrency)
+        await gather_fail_fast(*workers)
+    finally:
+        await manager.close()
+        await asyncio.to_thread(writer.close)
+        if cache is not None:
+            cache.close()           # commits the last batch of cached answers
+
+    print(f"✅ completed {sum(rec is not None for rec in results)} answers → {output_path}")
+
+
+# ---------- CLI --------------------------------------------------------------
+def add_common_args(p: argparse.ArgumentParser) -> argparse.ArgumentParser:
+    """Flags shared by every Claude pipeline entrypoint."""
+    p.add_argument("--repo_path",      required=True)
+    p.add_argument("--questions_file", required=True)
+    p.add_argument("--model", default="claude-3-7-sonnet-20250219")
+    p.add_argument("--output_file")
+    p.add_argument("--backend", choices=["cli", "api"], default="cli",
+                   help="cli: `claude -p` with Read access to the work-tree; "
+                        "api: pooled Messages API client (no file access)")
+    p.add_argument("--resume", required=False, action="store_true", default=False)
+    p.add_argument("--max_concurrency", type=int, default=MAX_CONCURRENCY,
+                   help="simultaneous Claude invocations")
+    p.add_argument("--answer_cache", type=Path, default=None,
+                   help="sqlite file caching answers by (backend, model, commit, prompt); unset = no cache")
+    return p
@@ -1,13 +1,29 @@
-import json, aiofiles, traceback
+import asyncio
+import traceback
+import orjson
 from typing import Dict, Any, Callable
-from utils.json_repair import JSONRepairAgent
 from langchain_core.exceptions import OutputParserException
-from langchain.agents import create_tool_calling_agent
-from codebase_qna.construct.construct_qna import create_question_agent, create_answer_agent
+from utils.json_repair import fast_repair_json, restore_prefilled_brace
+from utils.response_cache import cache_key
 from langchain.agents import AgentExecutor
 import re
 
-json_repair = JSONRepairAgent(model_name="gpt-4.1-mini")
+JSON_FENCE_RE = re.compile(r"```json\n(.*?)\n```", re.DOTALL)    # multi-line fenced block
+JSON_OBJECT_RE = re.compile(r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}')   # { ... } with one level of nesting
+
+def agent_executor(agent, tools, verbose: bool = False, **kwargs) -> AgentExecutor:
+    """
+    Per-PR executor around a prebuilt agent runnable; only the tool callables differ per worktree.
+    Step-by-step console traces are opt-in (--verbose): with many PRs in flight they interleave
+    and cost a synchronous print per step. Intermediate steps are only kept when there are tools.
+    """
+    return AgentExecutor(
+        agent=agent,
+        tools=tools,
+        verbose=verbose,
+        return_intermediate_steps=bool(tools),
+        **kwargs,
+    )
 
 def stage(fn: Callable[..., Any]) -> Callable[..., Any]:
     """Decorator: wrap every stage with error capture + timing."""
@@ -34,7 +50,16 @@ async def parse_json_output(
 ) -> Dict[str, Any]:
     """Attempts multiple strategies to parse or repair a model-compatible JSON output."""
     pr_number = ctx["pr"]["pr_number"]
-    raw = text.strip()
+    # dispatch on shape instead of trying every strategy in turn: output that opens at a
+    # key (the prompt prefilled "{") gets its brace back once, so the fast path sees JSON
+    raw = restore_prefilled_brace(text.strip())
+
+    # already-valid JSON: one pydantic-core parse + validate, no markdown scan
+    if raw[:1] in ("{", "["):
+        try:
+            return model_class.model_validate_json(raw)
+        except ValueError:
+            pass
 
     # Try parser with wrapped JSON
     try:
@@ -48,30 +73,32 @@ async def parse_json_output(
         })
         pass
 
-    try:
-        return parser.parse("{" + raw)
-    except OutputParserException as e:
-        pass
-
-    # regex extract json
-    try:
-        return parser.parse(re.search(r"```json\n(.*)\n```", raw).group(1))
-    except Exception:
-        pass
+    # regex extract json (only when there is a fence to find)
+    if "```" in raw:
+        try:
+            return parser.parse(JSON_FENCE_RE.search(raw).group(1))
+        except Exception:
+            pass
 
     # regex extract json by matching { ... }
     try:
-        # Use non-greedy match and handle nested braces
-        pattern = r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}'
-        match = re.search(pattern, raw)
+        match = JSON_OBJECT_RE.search(raw)
         if match:
             return parser.parse(match.group(0))
     except Exception:
         pass
 
+    # deterministic repair (string-aware brace scan + orjson) before paying for an LLM call
+    if (data := fast_repair_json(raw)) is not None:
+        try:
+            return model_class.model_validate(data)
+        except ValueError:
+            pass
+
     # Try repair with raw JSON
     try:
-        return repair_agent.repair_json_output(raw, model_class)
+        # sync OpenAI call with time.sleep backoff: keep it off the loop so other PRs keep running
+        return await asyncio.to_thread(repair_agent.repair_json_output, raw, model_class)
     except Exception as e:
         ctx["error_log"].append({
             "stage": f"parse_{model_label.lower()}",
@@ -81,30 +108,30 @@ async def parse_json_output(
         })
         pass
 
-    # Try repair with wrapped JSON
-    try:
-        return repair_agent.repair_json_output("{" + raw, model_class)
-    except Exception as e:
-        ctx["error_log"].append({
-            "stage": f"parse_{model_label.lower()}",
-            "pr_number": pr_number,
-            "error": f"Attempt 2: Failed to parse/repair {model_label} from output: {str(e)}",
-            "raw_output": raw[:500]
-        })
+    # Try repair with wrapped JSON; skipped when raw already opens an object (it would send "{{")
+    if not raw.startswith("{"):
+        try:
+            return await asyncio.to_thread(repair_agent.repair_json_output, "{" + raw, model_class)
+        except Exception as e:
+            ctx["error_log"].append({
+                "stage": f"parse_{model_label.lower()}",
+                "pr_number": pr_number,
+                "error": f"Attempt 2: Failed to parse/repair {model_label} from output: {str(e)}",
+                "raw_output": raw[:500]
+            })
 
-        print(f"Failed to parse/repair {text} from output: {str(e)}")
+    print(f"Failed to parse/repair {model_label} from output: {text[:500]}")
 
-        return default
+    return default
 
 @stage
 async def generate_qna(ctx):
     tools = ctx["tools"]
-    llm = ctx["llm"]
 
     # -------- QUESTION --------
     q_tool_calls = []
     try:
-        question_agent = create_question_agent(llm, tools)
+        question_agent = agent_executor(ctx["question_agent"], tools, ctx["verbose"], max_iterations=None)
 
          
         q_raw = await question_agent.ainvoke(
@@ -125,7 +152,7 @@ async def generate_qna(ctx):
             q_text, 
             model_label="Question", 
             parser=ctx["question_parser"], 
-            repair_agent=json_repair, 
+            repair_agent=ctx["json_repair"], 
             model_class=ctx["QuestionModel"], 
             ctx=ctx, 
             default=ctx["QuestionModel"](question="Failed to generate question")
@@ -145,7 +172,7 @@ async def generate_qna(ctx):
     # -------- ANSWER ----------
     a_tool_calls = []
     try:
-        answer_agent = create_answer_agent(llm, tools)
+        answer_agent = agent_executor(ctx["answer_agent"], tools, ctx["verbose"], max_iterations=None)
         a_raw = await answer_agent.ainvoke(
             {
                 "question": ctx["question"],
@@ -159,7 +186,7 @@ async def generate_qna(ctx):
             a_text, 
             model_label="Answer", 
             parser=ctx["answer_parser"], 
-            repair_agent=json_repair, 
+            repair_agent=ctx["json_repair"], 
             model_class=ctx["AnswerModel"], 
             ctx=ctx, 
             default=ctx["AnswerModel"](answer=a_text, sources=["Failed to generate sources"])
@@ -186,85 +213,95 @@ async def generate_qna(ctx):
         ctx["sources"] = "Failed to generate sources"
 
     # -------- persist ---------
-    async with aiofiles.open(ctx["qna_path"], "a") as f:
-        await f.write(
-            json.dumps(
-                {
-                    "pr_number": ctx["pr"]["pr_number"],
-                    "commit_hash": ctx["pr"]["base_commit"],
-                    "question": ctx["question"],
-                    "answer": ctx["answer"],
-                    "sources": ctx["sources"],
-                    "question_tool_calls": q_tool_calls,
-                    "answer_tool_calls": a_tool_calls,
-                    "errors": ctx["error_log"],
-                }
-            )
-            + "\n"
+    ctx["qna_writer"].put(
+        orjson.dumps(
+            {
+                "pr_number": ctx["pr"]["pr_number"],
+                "commit_hash": ctx["pr"]["base_commit"],
+                "question": ctx["question"],
+                "answer": ctx["answer"],
+                "sources": ctx["sources"],
+                "question_tool_calls": q_tool_calls,
+                "answer_tool_calls": a_tool_calls,
+                "errors": list(ctx["error_log"]),
+            },
+            option=orjson.OPT_NON_STR_KEYS,
         )
-        await f.flush()
-        print(f"📝 qna appended for PR {ctx['pr']['pr_number']}")  # <— debug
+        + b"\n"
+    )
+    print(f"📝 qna queued for PR {ctx['pr']['pr_number']}")  # <— debug
 
     return ctx
 
 @stage
 async def generate_rubric(ctx):
-    llm = ctx["llm"]
     tools = ctx["tools"]
 
-    rubric_agent = create_tool_calling_agent(llm, tools, prompt=ctx["rubric_prompt"])
-    rubric_agent =AgentExecutor.from_agent_and_tools(
-        agent=rubric_agent,
-        tools=tools,
-        verbose=True,
-        return_intermediate_steps=True
-    )
+    rubric_agent = agent_executor(ctx["rubric_agent"], tools, ctx["verbose"])
 
     r_parsed = None
     r_tool_calls = []
 
-    try:
-        # async with agent_log_to_file(ctx["pr"]["pr_number"], "rubric_agent"):
-        raw = await rubric_agent.ainvoke(
-            {
-                "query": ctx.get("question", ""),
-                "answer": ctx.get("answer", ""),
-                "sources": ctx.get("sources", []),
-            }
-        )
+    # exact-match cache (--rubric_cache): the agent's tools read this commit's worktree and
+    # this PR's diff, so both are in the key
+    cache = ctx.get("rubric_cache")
+    key = hit = None
+    if cache is not None:
+        key = cache_key(ctx["llm"].model, ctx["pr"]["base_commit"], ctx["pr"].get("diff", ""),
+                        ctx.get("question", ""), ctx.get("answer", ""),
+                        orjson.dumps(ctx.get("sources", [])).decode())
+        hit = cache.get(key)
+
+    if hit is not None:
+        print(f"⚡ rubric cache hit for PR {ctx['pr']['pr_number']}")
+        r_parsed = ctx["RubricModel"].model_validate(hit["rubric"])
+        r_tool_calls = hit["tool_calls"]
+    else:
+        try:
+            raw = await rubric_agent.ainvoke(
+                {
+                    "query": ctx.get("question", ""),
+                    "answer": ctx.get("answer", ""),
+                    "sources": ctx.get("sources", []),
+                }
+            )
 
-        output = raw.get("output")
-        if isinstance(output, list):
-            r_text = output[0].get("text", "")
-        elif isinstance(output, dict) and "text" in output:
-            r_text = output["text"]
-        else:
-            r_text = output if isinstance(output, str) else ""
-
-        r_parsed = await parse_json_output(
-            r_text, 
-            model_label="Rubric", 
-            parser=ctx["rubric_parser"], 
-            repair_agent=json_repair, 
-            model_class=ctx["RubricModel"], 
-            ctx=ctx, 
-            default=ctx["RubricModel"](title="Failed to generate rubric", criteria=[])
-        )
+            output = raw.get("output")
+            if isinstance(output, list):
+                r_text = output[0].get("text", "")
+            elif isinstance(output, dict) and "text" in output:
+                r_text = output["text"]
+            else:
+                r_text = output if isinstance(output, str) else ""
+
+            r_parsed = await parse_json_output(
+                r_text, 
+                model_label="Rubric", 
+                parser=ctx["rubric_parser"], 
+                repair_agent=ctx["json_repair"], 
+                model_class=ctx["RubricModel"], 
+                ctx=ctx, 
+                default=ctx["RubricModel"](title="Failed to generate rubric", criteria=[])
+            )
 
-        r_tool_calls = [
-            {
-                "tool": action.tool,
-                "input": action.tool_input,
-                "output": str(observation)[:20]
-            }
-            for action, observation in raw.get("intermediate_steps", [])
-        ]
+            r_tool_calls = [
+                {
+                    "tool": action.tool,
+                    "input": action.tool_input,
+                    "output": str(observation)[:20]
+                }
+                for action, observation in raw.get("intermediate_steps", [])
+            ]
+
+        except Exception as e:
+            ctx["error_log"].append(
+                {"stage": "create_rubric_agent", "pr_number": ctx["pr"]["pr_number"], "error": str(e)}
+            )
+
+        # only real rubrics are cached, so --resume still re-runs failures
+        if key is not None and r_parsed is not None and r_parsed.title != "Failed to generate rubric":
+            cache.set(key, {"rubric": r_parsed.model_dump(), "tool_calls": r_tool_calls})
 
-    except Exception as e:
-        ctx["error_log"].append(
-            {"stage": "create_rubric_agent", "pr_number": ctx["pr"]["pr_number"], "error": str(e)}
-        )
-    
     rubric_output = (
         r_parsed.model_dump()
         if r_parsed else 
@@ -272,19 +309,22 @@ async def generate_rubric(ctx):
     )
 
     
-    async with aiofiles.open(ctx["rubric_path"], "a") as f:
-        await f.write(
-            json.dumps(
-                {
-                    "pr_number": ctx["pr"]["pr_number"],
-                    "commit_hash": ctx["pr"]["base_commit"],
-                    "rubric": rubric_output,
-                    "errors": ctx["error_log"],
-                    "rubric_tool_calls": r_tool_calls,
-                }
-            ) + "\n")
-        await f.flush()
-        print(f"📝 rubric appended for PR {ctx['pr']['pr_number']}")  # <— debug
+    ctx["rubric_writer"].put(
+        orjson.dumps(
+            {
+                "pr_number": ctx["pr"]["pr_number"],
+                "commit_hash": ctx["pr"]["base_commit"],
+                "rubric": rubric_output,
+                "errors": list(ctx["error_log"]),
+                "rubric_tool_calls": r_tool_calls,
+            },
+            option=orjson.OPT_NON_STR_KEYS,
+        ) + b"\n")
+    print(f"📝 rubric queued for PR {ctx['pr']['pr_number']}")  # <— debug
 
     return ctx
 
+
+async def pipeline(ctx):
+    """Both stages for one PR; run across PRs under one bound, so PR A's rubric overlaps PR B's QnA."""
+    return await generate_rubric(await generate_qna(ctx))
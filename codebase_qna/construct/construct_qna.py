@@ -4,6 +4,7 @@ from pydantic import BaseModel, Field
 from typing import List
 from langchain_core.tools import tool, Tool
 import json
+import orjson
 from langchain_anthropic import ChatAnthropic
 from langchain.agents import AgentExecutor
 from langchain_core.exceptions import OutputParserException
@@ -12,6 +13,7 @@ import os
 from langchain.agents import create_tool_calling_agent
 from utils.agent_tools import create_list_files_tool, create_read_file_tool, create_read_diff_from_link_tool
 from utils.codebase_utils import WorktreeManager
+from utils.json_repair import restore_prefilled_brace
 from codebase_qna.prompt_templates.prompts import QUESTION_SYSTEM_PROMPT, ANSWER_SYSTEM_PROMPT
 
 class Question(BaseModel):
@@ -51,11 +53,22 @@ answer_prompt = ChatPromptTemplate.from_messages([
     format_instructions=answer_parser.get_format_instructions()
 )
 
-def create_question_agent(llm, tools: List[Tool]) -> AgentExecutor:
-    agent = create_tool_calling_agent(llm, tools=tools, prompt=question_prompt)
+# The agent runnable depends only on the llm, the prompt and the tool schemas (name,
+# description, args), not on which worktree a tool reads, so it is built once per
+# (llm, prompt, tool names + descriptions) and every PR just gets a fresh AgentExecutor
+# around it. Descriptions are in the key because read_diff_from_link's names the PR's diff URL.
+_agents: dict = {}
+
+def cached_agent(llm, tools: List[Tool], prompt: ChatPromptTemplate):
+    key = (id(llm), id(prompt), tuple((t.name, t.description) for t in tools))
+    if key not in _agents:
+        # llm kept in the value so its id cannot be recycled while the entry lives
+        _agents[key] = (llm, create_tool_calling_agent(llm, tools=tools, prompt=prompt))
+    return _agents[key][1]
 
+def create_question_agent(llm, tools: List[Tool]) -> AgentExecutor:
     question_agent = AgentExecutor.from_agent_and_tools(
-        agent=agent,
+        agent=cached_agent(llm, tools, question_prompt),
         tools=tools,
         verbose=True,
         return_intermediate_steps=True,
@@ -64,11 +77,8 @@ def create_question_agent(llm, tools: List[Tool]) -> AgentExecutor:
     return question_agent
 
 def create_answer_agent(llm, tools: List[Tool]) -> AgentExecutor:
-
-    agent = create_tool_calling_agent(llm, tools=tools, prompt=answer_prompt)
-
     answer_agent = AgentExecutor.from_agent_and_tools(
-        agent=agent,
+        agent=cached_agent(llm, tools, answer_prompt),
         tools=tools,
         verbose=True,
         return_intermediate_steps=True,
@@ -117,7 +127,7 @@ def main(repo_path: str, merged_prs_path: str):
                 raw_response = question_agent.invoke({"merged_pull_request": merged_pull_request, "codebase_files": codebase_files})
                 raw_text = raw_response['output'][0]["text"]
                 try:
-                    parsed_response = question_parser.parse("{" + raw_text)
+                    parsed_response = question_parser.parse(restore_prefilled_brace(raw_text))
                 except OutputParserException as e:
                     print(f"Error parsing answer: {raw_text}")
                     parsed_response = json_repair_agent.repair_json_output(raw_text, Question)
@@ -131,7 +141,7 @@ def main(repo_path: str, merged_prs_path: str):
                 raw_text = raw_response['output'][0]["text"]
 
                 try:
-                    parsed_response = answer_parser.parse("{" + raw_text)
+                    parsed_response = answer_parser.parse(restore_prefilled_brace(raw_text))
                 except OutputParserException as e:
                     print(f"Error parsing answer: {raw_text}")
                     parsed_response = json_repair_agent.repair_json_output(raw_text, Answer)
@@ -154,9 +164,8 @@ def main(repo_path: str, merged_prs_path: str):
                 break
 
     output_filename = f"logs/{merged_prs_path.split('/')[-2]}/qna_from_prs.jsonl"
-    with open(output_filename, "w") as f:
-        for question_answer in questions_answers:
-            f.write(json.dumps(question_answer) + "\n")
+    with open(output_filename, "wb") as f:
+        f.write(b"".join(orjson.dumps(qa, option=orjson.OPT_APPEND_NEWLINE) for qa in questions_answers))
 
 if __name__ == "__main__":
     import argparse
@@ -4,6 +4,7 @@ from langchain_core.messages import SystemMessage
 from pydantic import BaseModel, Field
 from typing import List
 import json
+import orjson
 from langchain_anthropic import ChatAnthropic
 from langchain.agents import AgentExecutor
 from dotenv import load_dotenv
@@ -12,6 +13,9 @@ from langchain.agents import create_tool_calling_agent
 import argparse
 from langchain_core.exceptions import OutputParserException
 from codebase_qna.prompt_templates.prompts import RUBRIC_SYSTEM_PROMPT
+from utils.json_repair import restore_prefilled_brace
+
+RUBRIC_CONCURRENCY = 8     # rubric requests in flight at once in main()
 
 class Criterion(BaseModel):
     name: str = Field(..., description="The name of the evaluation criterion.")
@@ -60,7 +64,6 @@ def main(args):
         agent=agent,
         tools=tools,
         verbose=True,
-        return_intermediate_steps=True
     )
 
     from utils.json_repair import JSONRepairAgent
@@ -68,23 +71,23 @@ def main(args):
 
     # Open all files simultaneously
     with open(args.qna_path, 'r') as qna_file:
-        # Create iterators for each file
-        qna_pairs = (json.loads(line.strip()) for line in qna_file)
+        qna_pairs = [json.loads(line.strip()) for line in qna_file]
+
+        # no tools and no cross-PR dependency: keep RUBRIC_CONCURRENCY requests in flight
+        # instead of one blocking call at a time (one prompt per PR, so rubrics stay independent)
+        raw_responses = rubric_agent.batch(
+            [{"query": qna_pair["question"], "answer": qna_pair["answer"], "sources": qna_pair["sources"]}
+             for qna_pair in qna_pairs],
+            config={"max_concurrency": RUBRIC_CONCURRENCY},
+        )
 
         rubrics = {}
-        for qna_pair in qna_pairs:
+        for qna_pair, raw_response in zip(qna_pairs, raw_responses):
             question = qna_pair["question"]
-            answer = qna_pair["answer"]
-            sources = qna_pair["sources"]
-
-            raw_response = rubric_agent.invoke({
-                "query": question,
-                "answer": answer,
-                "sources": sources
-            })
+
             raw_text = raw_response['output'][0]["text"]
             try:
-                parsed_response = rubric_parser.parse("{" + raw_text)
+                parsed_response = rubric_parser.parse(restore_prefilled_brace(raw_text))
             except OutputParserException as e:
                 print(f"Error parsing rubric: {raw_text}")
                 parsed_response = json_repair_agent.repair_json_output(raw_text, Rubric)
@@ -93,8 +96,8 @@ def main(args):
 
             rubrics[question] = parsed_response.model_dump()
 
-        with open(output_path, 'a') as f:
-            f.write(json.dumps(rubrics) + "\n")  
+        with open(output_path, 'ab') as f:
+            f.write(orjson.dumps(rubrics, option=orjson.OPT_APPEND_NEWLINE))
 
     print(f"Rubric written to {output_path}")
 
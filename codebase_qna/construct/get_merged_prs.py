@@ -1,71 +1,138 @@
 import aiohttp
 import asyncio
 import os
-import json
+import orjson
 import time
 import argparse
+import random
+import re
 from datetime import datetime
 from typing import List, Dict
 from dotenv import load_dotenv
-import json
+from pathlib import Path
+from contextlib import asynccontextmanager
+from itertools import islice
+from utils.async_utils import install_uvloop, run_bounded
+from utils.jsonl_utils import JsonlWriter, iter_jsonl_lines
+from utils.rate_limit import RateLimitGate
+from utils.response_cache import ResponseCache, cache_key
 
 load_dotenv()
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 BASE_URL = "https://api.github.com"
 
+# PR-detail pipelines in flight at once; each fans out into its own commit/diff requests,
+# so this plus the connector caps keep us under GitHub's secondary rate limits
+GH_CONCURRENCY = int(os.getenv("GH_CONCURRENCY", "20"))
+GH_MAX_CONNECTIONS = 64   # total open sockets; every HTTP request (commit fan-out included) queues on these
+
+# sent with every request by the shared session; diff endpoints only override Accept
+GH_HEADERS = {"Authorization": f"token {GITHUB_TOKEN}", "Accept": "application/vnd.github.v3+json"}
+DIFF_HEADERS = {"Accept": "application/vnd.github.v3.diff"}
+PATCH_HEADERS = {"Accept": "application/vnd.github.v3.patch"}
+
+# each commit of a PR's format-patch series opens with this mbox line (diff lines are
+# always prefixed with +/-/space, so they can't match)
+PATCH_FROM_RE = re.compile(r"^From ([0-9a-f]{40}) Mon Sep 17 00:00:00 2001$", re.MULTILINE)
+# format-patch signature trailer ("-- \n2.39.5\n\n") closing each commit's block
+PATCH_SIGNATURE_RE = re.compile(r"\n-- \n[^\n]*\n*\Z")
+# "diff --git a/<path> b/<path>" header of each file in a unified diff
+DIFF_GIT_RE = re.compile(r"^diff --git a/(\S*)", re.MULTILINE)
+
+# merged PRs and commits don't change, so their details are cached across runs (--no_cache to skip)
+GH_CACHE_PATH = Path(os.getenv("XDG_CACHE_HOME", Path.home() / ".cache")) / "synthetic-evals" / "github.sqlite"
+
+GH_MAX_ATTEMPTS = 5
+GH_RETRY_STATUS = {500, 502, 503, 504}   # transient server side; rate limits are handled separately
+GH_MIN_REMAINING = 50                    # below this many requests left, pause everyone until the reset
+GH_DEFAULT_COOLDOWN = 60.0               # secondary limit without headers: GitHub asks for >= 1 minute
+
+# one cooldown shared by every request, so a rate-limit answer pauses the whole scraper
+github_gate = RateLimitGate()
+
+
+def rate_limit_delay(resp: aiohttp.ClientResponse) -> float | None:
+    """Seconds to back off if `resp` is a GitHub rate-limit answer (403/429), else None."""
+    if resp.status not in (403, 429):
+        return None
+    if (retry_after := resp.headers.get("Retry-After")) is not None:
+        return float(retry_after)
+    if resp.headers.get("X-RateLimit-Remaining") == "0":
+        return max(0.0, float(resp.headers.get("X-RateLimit-Reset", 0)) - time.time()) + 1
+    return GH_DEFAULT_COOLDOWN if resp.status == 429 else None   # plain 403 = no access
+
+
+def pace(resp: aiohttp.ClientResponse):
+    """Proactively close the gate until the window resets once the remaining budget runs low."""
+    remaining = resp.headers.get("X-RateLimit-Remaining")
+    if remaining is not None and 0 < int(remaining) < GH_MIN_REMAINING:
+        github_gate.trip(max(0.0, float(resp.headers.get("X-RateLimit-Reset", 0)) - time.time()) + 1)
+
+
+@asynccontextmanager
+async def gh_get(session: aiohttp.ClientSession, url: str, **kwargs):
+    """
+    `session.get` that honours GitHub's limits: every request waits at `github_gate`, a rate-limit
+    answer closes the gate for Retry-After / until X-RateLimit-Reset and is retried, and transient
+    5xx are retried with backoff. The last attempt's response is handed back as is.
+    """
+    for attempt in range(GH_MAX_ATTEMPTS):
+        await github_gate.wait()
+        resp = await session.get(url, **kwargs)
+        pace(resp)
+        delay = rate_limit_delay(resp)
+        if attempt == GH_MAX_ATTEMPTS - 1 or (delay is None and resp.status not in GH_RETRY_STATUS):
+            break
+        resp.release()
+        if delay is not None:
+            print(f"⚠️ GitHub rate limit ({resp.status}), pausing requests for {delay:.0f}s")
+            github_gate.trip(delay)
+        else:
+            backoff = 0.5 * 2 ** attempt + random.uniform(0, 0.5)
+            print(f"⚠️ GitHub {resp.status} for {url}, retrying in {backoff:.1f}s")
+            await asyncio.sleep(backoff)
+    try:
+        yield resp
+    finally:
+        resp.release()
+
+
 def format_pr_intent(pr_data: Dict) -> str:
+    """Plain-text PR summary for the question agent, built as one list and joined once."""
     pr_number = pr_data.get("number", "")
     title = pr_data.get("title", "")
     body = pr_data.get("body", "") or "No description provided."
 
+    parts = [f"Pull Request #{pr_number}: {title}\n\nPR Description:\n> {body}\n\nCommits and Diffs:\n"]
+
     all_commits = pr_data.get("all_commits", [])
     if all_commits:
-        commit_blocks = "\n\n".join(
-            f"- Commit [{c['sha'][:7]}]: {c['message'].strip()}\n  Diff:\n{c.get('diff', '').strip()}"
-            for c in all_commits
-        )
+        for c in all_commits:
+            # diffs go in as-is (no strip copy of MBs of text); they already end in a newline
+            parts += [f"- Commit [{c['sha'][:7]}]: {c['message'].strip()}\n  Diff:\n", c.get("diff", ""), "\n"]
     else:
-        commit_blocks = pr_data.get("diff", "")
+        parts += [pr_data.get("diff", ""), "\n"]
 
+    parts.append("\nReviewer Comments:\n")
     review_comments = pr_data.get("review_comments", [])
     if review_comments:
-        review_lines = "\n".join(
-            f"- {c['user']['login']}: {c['body'].strip()}" for c in review_comments
-        )
+        parts.append("\n".join(f"- {c['user']['login']}: {c['body'].strip()}" for c in review_comments))
     else:
-        review_lines = "No reviewer comments."
+        parts.append("No reviewer comments.")
 
-    return f"""\
-        Pull Request #{pr_number}: {title}
-
-        PR Description:
-        > {body}
-
-        Commits and Diffs:
-        {commit_blocks}
-
-        Reviewer Comments:
-        {review_lines}
-    """.strip()
+    return "".join(parts)
 
 
 async def fetch_review_comments(session, review_comments_url):
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    }
-    async with session.get(review_comments_url, headers=headers) as resp:
+    """Review comments of a PR, or None if the request failed (so callers don't cache a fake [])."""
+    async with gh_get(session, review_comments_url) as resp:
         if resp.status == 200:
             return await resp.json()
         else:
-            return []
+            return None
         
 async def fetch_diff(session, diff_url):
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3.diff"
-    }
-    async with session.get(diff_url, headers=headers) as resp:
+    async with gh_get(session, diff_url, headers=DIFF_HEADERS) as resp:
         if resp.status == 200:
                 try:
                     raw_diff = await resp.read()
@@ -89,29 +156,26 @@ async def fetch_pr_page(session: aiohttp.ClientSession, owner: str, repo: str, p
         "per_page": 100,
         "page": page
     }
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    }
-    async with session.get(url, headers=headers, params=params) as response:
+    async with gh_get(session, url, params=params) as response:
         if response.status != 200:
             print(f"Failed to fetch page {page}: {response.status}")
             return []
         return await response.json()
     
-async def fetch_commit_diff_details(owner: str, repo: str, commit_sha: str, commit_message: str, session, BASE_URL: str, GITHUB_TOKEN: str) -> Dict:
+async def fetch_commit_diff_details(owner: str, repo: str, commit_sha: str, commit_message: str, session, BASE_URL: str,
+                                    cache: ResponseCache | None = None) -> Dict:
     """
-    Fetches the diff for a single commit.
+    Fetches the diff for a single commit (from `cache` when this sha was fetched before).
     """
+    key = cache_key("commit", owner, repo, commit_sha)
+    if cache is not None and (hit := cache.get(key)) is not None:
+        return hit
+
     commit_url = f"{BASE_URL}/repos/{owner}/{repo}/commits/{commit_sha}"
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3.diff"  # Request diff format
-    }
     diff_text = ""
 
     try:
-        async with session.get(commit_url, headers=headers) as diff_resp:
+        async with gh_get(session, commit_url, headers=DIFF_HEADERS) as diff_resp:
             if diff_resp.status == 200:
                 try:
                     raw_diff = await diff_resp.read()
@@ -128,39 +192,67 @@ async def fetch_commit_diff_details(owner: str, repo: str, commit_sha: str, comm
         # Handle potential exceptions from the request itself (e.g., network issues)
         diff_text = f"Error fetching diff for commit {commit_sha}: {str(e)}"
 
-    return {
+    result = {
         "sha": commit_sha,
         "message": commit_message,
         "diff": diff_text
     }
+    if cache is not None and not diff_text.startswith("Error"):
+        cache.set(key, result)
+    return result
+
+def split_patch_series(patch: str) -> Dict[str, str]:
+    """{sha: diff} for every commit in a PR's format-patch series (headers, message, diffstat and signature dropped)."""
+    diffs = {}
+    starts = list(PATCH_FROM_RE.finditer(patch))
+    for m, nxt in zip(starts, starts[1:] + [None]):
+        block = patch[m.end() : nxt.start() if nxt else len(patch)]
+        if sig := PATCH_SIGNATURE_RE.search(block):
+            block = block[: sig.start() + 1]    # keep the diff's own trailing newline
+        i = block.find("\ndiff --git ")
+        diffs[m.group(1)] = block[i + 1 :] if i >= 0 else ""
+    return diffs
+
+async def fetch_pr_details(session: aiohttp.ClientSession, owner: str, repo: str, pr_number: int,
+                           updated_at: str = "", cache: ResponseCache | None = None) -> Dict:
+    # updated_at (from the page listing) is in the key, so a PR touched since is refetched
+    key = cache_key("pr", owner, repo, str(pr_number), updated_at)
+    if cache is not None and (hit := cache.get(key)) is not None:
+        return hit
 
-async def fetch_pr_details(session: aiohttp.ClientSession, owner: str, repo: str, pr_number: int) -> Dict:
     pr_url = f"{BASE_URL}/repos/{owner}/{repo}/pulls/{pr_number}"
     commits_url = f"{BASE_URL}/repos/{owner}/{repo}/pulls/{pr_number}/commits"
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    }
 
-    async with session.get(pr_url, headers=headers) as pr_resp:
+    # False as soon as any sub-request fails; only complete records are cached
+    complete = True
+
+    async with gh_get(session, pr_url) as pr_resp:
+        complete &= pr_resp.status == 200
         pr_data = await pr_resp.json() if pr_resp.status == 200 else {}
 
-    async with session.get(commits_url, headers=headers) as commit_resp:
+    async with gh_get(session, commits_url) as commit_resp:
+        complete &= commit_resp.status == 200
         commit_list = await commit_resp.json() if commit_resp.status == 200 else []
 
-    commits: List[Dict] = []
-    for c in commit_list:
-        sha = c["sha"]
-        message = c["commit"]["message"]
+    # every commit's diff from one format-patch request instead of one /commits/{sha} call each
+    async with gh_get(session, pr_url, headers=PATCH_HEADERS) as patch_resp:
+        patch = await patch_resp.text(errors="replace") if patch_resp.status == 200 else ""
+    patch_diffs = split_patch_series(patch)
 
-        commit_details = await fetch_commit_diff_details(owner, repo, sha, message, session, BASE_URL, GITHUB_TOKEN)
-        commits.append(commit_details)
+    async def commit_details(c: Dict) -> Dict:
+        if c["sha"] in patch_diffs:
+            return {"sha": c["sha"], "message": c["commit"]["message"], "diff": patch_diffs[c["sha"]]}
+        # not in the series (merge commits, failed patch request): per-commit fetch as before;
+        # it turns its own failures into an "Error: ..." diff, so gather can't raise
+        return await fetch_commit_diff_details(owner, repo, c["sha"], c["commit"]["message"], session, BASE_URL, cache)
 
+    commits: List[Dict] = list(await asyncio.gather(*(commit_details(c) for c in commit_list)))
 
-        
     review_comments_url = pr_data.get("review_comments_url")
     if review_comments_url:
         review_comments = await fetch_review_comments(session, review_comments_url)
+        complete &= review_comments is not None
+        review_comments = review_comments or []
     else:
         review_comments = []
 
@@ -172,7 +264,7 @@ async def fetch_pr_details(session: aiohttp.ClientSession, owner: str, repo: str
 
     base_commit = commit_list[0]["sha"] if commit_list else None
 
-    return {
+    result = {
         "base_commit": base_commit,
         "all_commits": commits,
         "review_comments": review_comments,
@@ -181,25 +273,41 @@ async def fetch_pr_details(session: aiohttp.ClientSession, owner: str, repo: str
         "deletions": pr_data.get("deletions"),
         "changed_files": pr_data.get("changed_files")
     }
+    # only complete fetches are cached (merged PRs barely ever change updated_at, so a cached
+    # partial record would stick); a failed request is retried next run
+    complete &= not diff.startswith("Error") and not any(c["diff"].startswith("Error") for c in commits)
+    if cache is not None and complete:
+        cache.set(key, result)
+    return result
 
 
-async def gather_merged_prs(owner: str, repo: str, num_pages: int) -> List[Dict]:
-    async with aiohttp.ClientSession() as session:
+async def gather_merged_prs(owner: str, repo: str, num_pages: int, writer: JsonlWriter,
+                            cache: ResponseCache | None = None) -> int:
+    """
+    Fetch every merged PR from the last `num_pages` pages and hand each one to `writer` as soon
+    as its details are in (completion order), so only the PRs in flight are held in memory.
+    Returns the number of PRs written.
+    """
+    connector = aiohttp.TCPConnector(limit=GH_MAX_CONNECTIONS, limit_per_host=GH_MAX_CONNECTIONS,
+                                     keepalive_timeout=75, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector, headers=GH_HEADERS) as session:
         # Step 1: fetch all closed PRs from recent pages
         page_tasks = [fetch_pr_page(session, owner, repo, page) for page in range(1, num_pages + 1)]
         all_pages = await asyncio.gather(*page_tasks)
-        all_prs = [pr for page in all_pages for pr in page if pr.get("merged_at")]
-
-        # Step 2: fetch metadata for each merged PR
-        detail_tasks = [
-            fetch_pr_details(session, owner, repo, pr["number"])
-            for pr in all_prs
-        ]
-        details = await asyncio.gather(*detail_tasks)
-
-        final = []
-        for pr, detail in zip(all_prs, details):
-            final.append({
+        # a PR updated mid-run shifts between update-sorted pages and can be listed twice;
+        # keep its first listing so its details are fetched (and written) once
+        unique_prs: Dict[int, Dict] = {}
+        for page in all_pages:
+            for pr in page:
+                if pr.get("merged_at"):
+                    unique_prs.setdefault(pr["number"], pr)
+        all_prs = list(unique_prs.values())
+
+        # Step 2: fetch metadata for each merged PR, at most GH_CONCURRENCY at a time,
+        # and stream each finished record straight to the writer thread
+        async def fetch_and_write(pr: Dict):
+            detail = await fetch_pr_details(session, owner, repo, pr["number"], pr.get("updated_at", ""), cache)
+            writer.put(orjson.dumps({
                 "number": pr["number"],
                 "title": pr["title"],
                 "url": pr["html_url"],
@@ -210,25 +318,21 @@ async def gather_merged_prs(owner: str, repo: str, num_pages: int) -> List[Dict]
                 "baseRef": pr["base"]["ref"],
                 "headRef": pr["head"]["ref"],
                 **detail
-            })
-        return final
+            }, option=orjson.OPT_APPEND_NEWLINE))
+
+        await run_bounded(fetch_and_write, all_prs, max_pending=GH_CONCURRENCY)
+        return len(all_prs)
 
-def save_jsonl(data: List[Dict], output_path: str):
+def open_jsonl_writer(output_path: str) -> JsonlWriter:
+    """Fresh (truncated) output file behind a writer thread."""
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    with open(output_path, "w") as f:
-        for item in data:
-            f.write(json.dumps(item) + "\n")
+    Path(output_path).unlink(missing_ok=True)
+    return JsonlWriter(output_path)
 
 def extract_changed_files(diff_text: str) -> list[str]:
-    changed_files = []
-    for line in diff_text.splitlines():
-        if line.startswith("diff --git a/"):
-            parts = line.split()
-            if len(parts) >= 3:
-                # Strip off the `a/` and `b/` prefixes, they should be the same
-                a_path = parts[2][2:]  # Remove 'b/' prefix
-                changed_files.append(a_path)
-    return changed_files
+    # one C-level scan instead of splitting the whole diff into lines; the group is the
+    # `a/` path with its prefix stripped (a- and b-paths should be the same)
+    return DIFF_GIT_RE.findall(diff_text)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -238,6 +342,8 @@ if __name__ == "__main__":
     parser.add_argument("--output")
     parser.add_argument("--format_path", type=str, default=None)
     parser.add_argument("--num_to_format", type=int, default=None)
+    parser.add_argument("--no_cache", action="store_true",
+                        help=f"always refetch from GitHub instead of reusing {GH_CACHE_PATH}")
     args = parser.parse_args()
 
     if args.output is None:
@@ -247,32 +353,35 @@ if __name__ == "__main__":
         start = time.time()
         print(f"Fetching merged PRs from last {args.pages} pages...")
 
-        prs = asyncio.run(gather_merged_prs(args.owner, args.repo, args.pages))
-        print(f"Fetched {len(prs)} merged PRs")
-
-        save_jsonl(prs, args.output)
+        install_uvloop()                    # optional; falls back to the default loop
+        cache = None
+        if not args.no_cache:
+            GH_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+            cache = ResponseCache(GH_CACHE_PATH)
+        try:
+            with open_jsonl_writer(args.output) as writer:
+                num_prs = asyncio.run(gather_merged_prs(args.owner, args.repo, args.pages, writer, cache))
+        finally:
+            if cache is not None:
+                cache.close()       # commits the last batch of cached responses
+        print(f"Fetched {num_prs} merged PRs")
         print(f"Saved to {args.output}")
         print(f"Done in {time.time() - start:.2f} seconds")
 
-    else:
-        prs = []
-        with open(args.format_path) as f:
-            for line in f:
-                prs.append(json.loads(line.strip()))
-
-    formatted_prs = [
-        {
-            "pr_number": pr["number"],
-            "base_commit": pr["base_commit"],
-            "diff": pr["full_diff"],
-            "changed_files": extract_changed_files(pr["full_diff"]),
-            "summary": format_pr_intent(pr)
-        } 
-    for pr in prs[:args.num_to_format]
-    ]
-
-    save_jsonl(formatted_prs, args.output.replace(".jsonl", "_formatted.jsonl"))
-    print(f"Saved formatted PRs to {args.output.replace('.jsonl', '_formatted.jsonl')}")
+    # format one PR at a time from disk, never the whole list
+    formatted_path = args.output.replace(".jsonl", "_formatted.jsonl")
+    with open_jsonl_writer(formatted_path) as writer:
+        for line in islice(iter_jsonl_lines(args.format_path or args.output), args.num_to_format):
+            pr = orjson.loads(line)
+            writer.put(orjson.dumps({
+                "pr_number": pr["number"],
+                "base_commit": pr["base_commit"],
+                "diff": pr["full_diff"],
+                "changed_files": extract_changed_files(pr["full_diff"]),
+                "summary": format_pr_intent(pr)
+            }, option=orjson.OPT_APPEND_NEWLINE))
+
+    print(f"Saved formatted PRs to {formatted_path}")
 
 '''
 
@@ -1,96 +1,42 @@
-import subprocess
-import json
-import os
-from dotenv import load_dotenv
-import argparse
+"""
+Answer every question in a questions file with Claude. Thin entrypoint over
+claude_pipeline_core: defaults to the CLI backend, so answers stay grounded in the
+commit's work-tree; `--backend api` answers over the pooled Messages API client
+instead (faster, but no Read access to the repo).
+"""
+import asyncio, argparse
+import orjson
+from collections import defaultdict
 from pathlib import Path
-from utils.codebase_utils import WorktreeManager
+from utils.async_utils import install_uvloop
 from codebase_qna.prompt_templates.prompts import ANSWER_SYSTEM_PROMPT
+from codebase_qna.async_executors.claude_pipeline_core import run, add_common_args
 
-def main(args):
-    load_dotenv()
+PROMPT_PREFIX = (
+    f"{ANSWER_SYSTEM_PROMPT}\n"
+    "Also for the purposes of the question, answer as thoroughly as possible and try to "
+    "think of the true intent of the question. Therefore refrain from asking too many clarifications.\n"
+)
 
-    if args.output_file is None:
-        args.output_file = Path(args.questions_file).parent / "claude_code_answers.jsonl"
 
-    # Ensure the output directory exists
-    os.makedirs(os.path.dirname(args.output_file), exist_ok=True)
-    QUESTIONS_FILE = args.questions_file
-    REPO_PATH = args.repo_path
-    OUTPUT_FILE = args.output_file
+def build_prompt(item: dict) -> str:
+    return PROMPT_PREFIX + item["question"]
 
-    worktree_manager = WorktreeManager(REPO_PATH)
 
-    # Read questions
-    with open(QUESTIONS_FILE, 'r') as qf: 
-        questions = [json.loads(line) for line in qf]
+def load_groups(args: argparse.Namespace, skip: set):
+    """
+    Bucket every question by commit_hash, wherever it sits in the file, so each
+    commit's work-tree is checked out once for all of its questions.
+    """
+    groups = defaultdict(list)
+    with Path(args.questions_file).open('rb') as f:
+        for q in map(orjson.loads, f):
+            if q["pr_number"] not in skip:
+                groups[q["commit_hash"]].append(q)
+    return groups.items()
 
-    for item in questions:
-        commit_hash = item["commit_hash"]
-        question = item["question"]
-        CLAUDE_CODE_PROMPT = f"""
-        {ANSWER_SYSTEM_PROMPT}
-        Also for the purposes of the question, answer as thoroughly as possible and try to think of the true intent of the question. Therefore refrain from asking too many clarifications.
-        {question}
-        """.format(ANSWER_SYSTEM_PROMPT=ANSWER_SYSTEM_PROMPT)
-
-        # Create a temporary directory for the worktree
-        try:
-            worktree_path = worktree_manager.create(commit_hash)
-        except Exception as e:
-            print(f"Error creating worktree for commit {commit_hash}: {e}")
-            continue
-
-        try:
-
-            # Run Claude Code in non-interactive mode
-            print(f"Running Claude Code for commit {commit_hash}")
-            process = subprocess.Popen(
-                ["claude", "-p", CLAUDE_CODE_PROMPT, "--allowedTools", f"Read({worktree_path})"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1  # Line-buffered
-            )
-
-            # Stream output line by line
-            for line in process.stdout:
-                print(line, end='')  # Already includes newline
-
-            process.wait()
-
-            # Capture the response
-            response = process.stdout.read().strip()
-
-            # Append the response to the output file
-            with open(OUTPUT_FILE, 'a') as outf:
-                json.dump({
-                    "pr_number": item["pr_number"],
-                    "commit_hash": commit_hash,
-                    "question": question,
-                    "response": response
-                }, outf)
-                outf.write('\n')
-
-            print(f"Generated answer for pr {item['pr_number']}")
-
-        except Exception as e:
-            print(f"Error generating answer for commit {commit_hash}: {e}")
-            continue
-
-        try:
-            worktree_manager.down(commit_hash)
-        except Exception as e:
-            print(f"Error removing worktree for commit {commit_hash}: {e}")
-            continue
-
-        break
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--repo_path", type=str, required=True)
-    parser.add_argument("--questions_file", type=str, required=True)
-    parser.add_argument("--output_file", type=str)
-    args = parser.parse_args()
-
-    main(args)
\ No newline at end of file
+    install_uvloop()                    # optional; falls back to the default loop
+    args = add_common_args(argparse.ArgumentParser()).parse_args()
+    asyncio.run(run(build_prompt, load_groups, args))
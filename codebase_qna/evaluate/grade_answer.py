@@ -1,16 +1,20 @@
 import argparse
+import asyncio
+import os
 from pydantic import BaseModel, Field
 from langchain_core.output_parsers import PydanticOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from typing import List
 from langchain_core.tools import Tool
 from pathlib import Path
-import json
+import orjson
 from langchain_core.exceptions import OutputParserException
 import pandas as pd
 from codebase_qna.prompt_templates.prompts import GRADE_SYSTEM_PROMPT
 from langchain_core.messages import SystemMessage
 
+GRADE_CONCURRENCY = 8      # grade requests in flight at once in test_grade_answer()
+
 class CriterionGrade(BaseModel):
     name: str = Field(..., description="Name of the rubric criterion being graded.")
     score: int = Field(..., ge=0, le=4, description="Score from 0 to 4 according to the rubric levels.")
@@ -35,13 +39,12 @@ grade_rubric_prompt = ChatPromptTemplate.from_messages([
 
 def pretty_print_graded_rubric(raw_response: GradedRubric):
     parsed = raw_response.model_dump()
-    pretty = json.dumps(parsed, indent=2)
+    pretty = orjson.dumps(parsed, option=orjson.OPT_INDENT_2).decode()
     print(pretty)
 
-def test_grade_answer(args):
+async def test_grade_answer(args):
     from langchain_anthropic import ChatAnthropic
     from dotenv import load_dotenv
-    import os
     from langchain.agents import create_tool_calling_agent
     from langchain.agents import AgentExecutor
 
@@ -72,30 +75,34 @@ def test_grade_answer(args):
     agent = create_tool_calling_agent(llm=llm, tools=[], prompt=filled_prompt)
     executor = AgentExecutor.from_agent_and_tools(agent=agent, tools=[], verbose=True)
 
-    with open(args.question_path, 'r') as file_q, open(args.answer_path, 'r') as file_a, open(args.rubric_path, 'r') as file_r:
-        questions = (json.loads(line.strip()) for line in file_q)
-        answers = (json.loads(line.strip()) for line in file_a)
-        rubrics = (json.loads(line.strip()) for line in file_r)
-
-        for question, answer, rubric in zip(questions, answers, rubrics):
-            response = executor.invoke({
-                "rubric": json.dumps(rubric),
-                "question": question,
-                "answer": answer
-            })
-
-            try:
-                response = grade_rubric_parser.parse(response['output'][0]["text"])
+    with open(args.question_path, 'rb') as file_q, open(args.answer_path, 'rb') as file_a, open(args.rubric_path, 'rb') as file_r:
+        inputs = [
+            {"rubric": orjson.dumps(rubric).decode(), "question": question, "answer": answer}
+            for question, answer, rubric in zip(map(orjson.loads, file_q), map(orjson.loads, file_a), map(orjson.loads, file_r))
+        ]
 
-            except OutputParserException as e:
+    # all grades in flight at once, capped at GRADE_CONCURRENCY; results come back in input order.
+    # return_exceptions: one timeout / 429 fails its own item, not the whole batch
+    responses = await executor.abatch(inputs, config={"max_concurrency": GRADE_CONCURRENCY},
+                                      return_exceptions=True)
+
+    repair_agent = None
+    for i, response in enumerate(responses):
+        if isinstance(response, Exception):
+            print(f"❌ grade {i} failed (Q='{str(inputs[i]['question'])[:40]}…'): {response!r}")
+            continue
+        text = response['output'][0]["text"]
+        try:
+            graded = grade_rubric_parser.parse(text)
+        except OutputParserException:
+            if repair_agent is None:
                 from utils.json_repair import ClaudeJSONRepairAgent
                 repair_agent = ClaudeJSONRepairAgent()
-                response = repair_agent.repair_json_output(response['output'][0]["text"], GradedRubric)
-
+            graded = await repair_agent.repair_json_output(text, GradedRubric)
 
-            print(response.graded_criteria)
+        print(graded.graded_criteria)
 
-            display_rubric_locally(response)    
+        display_rubric_locally(graded)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -104,7 +111,7 @@ if __name__ == "__main__":
     parser.add_argument("--answer_path", type=str, required=True)
     args = parser.parse_args()
     
-    test_grade_answer(args)
+    asyncio.run(test_grade_answer(args))
 
     
 
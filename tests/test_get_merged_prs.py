@@ -0,0 +1,67 @@
+import pytest
+
+pytest.importorskip("aiohttp")
+pytest.importorskip("dotenv")
+
+from codebase_qna.construct.get_merged_prs import split_patch_series
+
+SHA1 = "1" * 40
+SHA2 = "2" * 40
+
+# two-commit series as GitHub's .patch endpoint / `git format-patch --stdout` emits it
+SERIES = f"""From {SHA1} Mon Sep 17 00:00:00 2001
+From: Dev <dev@example.com>
+Date: Mon, 2 Jun 2025 10:00:00 +0000
+Subject: [PATCH 1/2] add a
+
+---
+ a.txt | 1 +
+ 1 file changed, 1 insertion(+)
+ create mode 100644 a.txt
+
+diff --git a/a.txt b/a.txt
+new file mode 100644
+index 0000000..7898192
+--- /dev/null
++++ b/a.txt
+@@ -0,0 +1 @@
++a
+-- 
+2.39.5
+
+
+From {SHA2} Mon Sep 17 00:00:00 2001
+From: Dev <dev@example.com>
+Date: Mon, 2 Jun 2025 10:01:00 +0000
+Subject: [PATCH 2/2] drop a dashed line
+
+---
+ b.txt | 1 -
+ 1 file changed, 1 deletion(-)
+
+diff --git a/b.txt b/b.txt
+index 1111111..2222222 100644
+--- a/b.txt
++++ b/b.txt
+@@ -1,2 +1 @@
+ keep
+-- 
+-- 
+2.39.5
+
+"""
+
+
+def test_split_patch_series_two_commits():
+    diffs = split_patch_series(SERIES)
+    assert list(diffs) == [SHA1, SHA2]
+    assert diffs[SHA1] == (
+        "diff --git a/a.txt b/a.txt\nnew file mode 100644\nindex 0000000..7898192\n"
+        "--- /dev/null\n+++ b/a.txt\n@@ -0,0 +1 @@\n+a\n"
+    )
+    # a removed "- " line looks like the signature separator; only the trailer is cut
+    assert diffs[SHA2] == (
+        "diff --git a/b.txt b/b.txt\nindex 1111111..2222222 100644\n"
+        "--- a/b.txt\n+++ b/b.txt\n@@ -1,2 +1 @@\n keep\n-- \n"
+    )
+    assert all("2.39.5" not in d for d in diffs.values())
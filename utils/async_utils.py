@@ -0,0 +1,129 @@
+import asyncio
+import random
+from typing import Awaitable, Any, Callable
+
+
+async def gather_fail_fast(*aws: Awaitable) -> list[Any]:
+    """
+    Like asyncio.gather, but the first exception cancels every sibling still running.
+    Returns results in input order, with None for tasks that failed or were cancelled.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    if not tasks:
+        return []
+
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    except asyncio.CancelledError:
+        # we were cancelled ourselves -> take the children down with us
+        for t in tasks:
+            t.cancel()
+        await asyncio.wait(tasks)
+        raise
+
+    for t in pending:
+        t.cancel()
+    if pending:
+        await asyncio.wait(pending)
+        print(f"⚠️ task failed, cancelled {len(pending)} sibling(s)")
+
+    results = []
+    for t in tasks:
+        if t.cancelled():
+            results.append(None)
+        elif (exc := t.exception()) is not None:
+            print(f"⚠️ task failed → {exc!r}")
+            results.append(None)
+        else:
+            results.append(t.result())
+    return results
+
+
+
+async def _aiter(items):
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+async def run_bounded(make_coro: Callable[[Any], Awaitable], items, max_pending: int):
+    """
+    Run `make_coro(item)` for every item of a sync or async iterable, creating a task
+    only when fewer than `max_pending` are in flight, so task objects stay
+    O(max_pending) instead of O(N). Like gather, the first exception propagates.
+    """
+    pending: set[asyncio.Task] = set()
+    async for item in _aiter(items):
+        if len(pending) >= max_pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                t.result()
+        pending.add(asyncio.create_task(make_coro(item)))
+    if pending:
+        await asyncio.gather(*pending)
+
+
+class AdmissionController:
+    """
+    Counting limiter built on asyncio.Condition. Unlike asyncio.Semaphore,
+    `n_max` can be changed at runtime (e.g. backing off on 429s) via `resize`.
+    """
+    def __init__(self, n_max: int):
+        self.n_max = n_max
+        self.n = 0
+        self.cv = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.cv:
+            await self.cv.wait_for(lambda: self.n < self.n_max)
+            self.n += 1
+
+    async def release(self):
+        async with self.cv:
+            self.n -= 1
+            self.cv.notify(1)
+
+    async def resize(self, n_max: int):
+        async with self.cv:
+            self.n_max = max(1, n_max)
+            self.cv.notify_all()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        # shielded so a cancellation landing here can't leak a slot
+        await asyncio.shield(self.release())
+
+
+def install_uvloop() -> bool:
+    """Switch asyncio to uvloop's libuv loop when it's installed; no-op otherwise."""
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+async def retry_with_backoff(make_coro: Callable[[], Awaitable], retryable: Callable[[BaseException], bool],
+                             max_attempts: int = 5, base: float = 1.0, max_delay: float = 30.0,
+                             jitter: float = 0.5) -> Any:
+    """
+    Await `make_coro()` until it succeeds. Errors for which `retryable(e)` holds are retried
+    after min(base * 2**attempt + U(0, jitter), max_delay) seconds; anything else, or the
+    last attempt's error, is raised.
+    """
+    for attempt in range(max_attempts):
+        try:
+            return await make_coro()
+        except Exception as e:
+            if attempt == max_attempts - 1 or not retryable(e):
+                raise
+            delay = min(base * 2 ** attempt + random.uniform(0, jitter), max_delay)
+            print(f"⚠️ {type(e).__name__}, retrying in {delay:.1f}s ({attempt + 1}/{max_attempts - 1})")
+            await asyncio.sleep(delay)
@@ -4,8 +4,9 @@ from git import Repo, GitCommandError
 import shutil
 from typing import Tuple, List, Set
 import uuid
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import asyncio
+from contextlib import asynccontextmanager
 
 DEFAULT_IGNORED_DIRS = {'.git', '.next', 'node_modules', '__pycache__', 'venv', '.venv', '.DS_Store', '.idea'}
 
@@ -93,8 +94,10 @@ def make_code_text(files_dict, add_line_numbers=True):
         all_text += f"\n[end of {filename}]\n"
     return all_text.strip("\n")
 
+MAX_IDLE_WORKTREES = 2  # released worktrees kept on disk for reuse by the next PR on that commit
+
 class WorktreeManager:
-    def __init__(self, repo_path: str, task: str = None):
+    def __init__(self, repo_path: str, task: str = None, max_idle: int = MAX_IDLE_WORKTREES):
         if task:
             self.task_id = task + "_" + str(uuid.uuid4())
         else:
@@ -103,6 +106,7 @@ class WorktreeManager:
         self.repo_path = repo_path
         self.worktrees = {}
         self.origin_repo_path = repo_path
+        self.repo = Repo(self.origin_repo_path)  # opened once, shared by every acquire/create
 
         repo_name = Path(self.repo_path).name
 
@@ -121,22 +125,47 @@ class WorktreeManager:
                 print("Exiting...")
                 exit(1)
 
-        self.lock = asyncio.Lock()
         self.ref_counts = defaultdict(int)
-
+        self.commit_locks: dict[str, asyncio.Lock] = {}  # concurrent acquirers of one commit share one checkout
+        self.lock_users: dict[str, int] = {}             # holders + waiters of each commit lock
+        self.idle = OrderedDict()                      # commit -> path with no holders, LRU order
+        self.max_idle = max_idle
+        self.hierarchy_cache: dict[tuple[str, int], str] = {}  # (commit, max_depth) -> tree string
+
+
+    @asynccontextmanager
+    async def _commit_lock(self, commit: str):
+        """
+        Per-commit lock. The entry is dropped once nobody holds or waits on it and the
+        commit is neither referenced nor idle, so long runs don't keep one lock per commit.
+        """
+        lock = self.commit_locks.setdefault(commit, asyncio.Lock())
+        self.lock_users[commit] = self.lock_users.get(commit, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self.lock_users[commit] -= 1
+            if not self.lock_users[commit] and not self.ref_counts.get(commit) and commit not in self.idle:
+                del self.lock_users[commit], self.commit_locks[commit]
 
     async def acquire(self, commit: str) -> Path:
-        async with self.lock:
-            if commit in self.worktrees and self.worktrees[commit].exists():
+        """Ref-counted checkout of `commit`; only the first holder pays for `git worktree add`."""
+        async with self._commit_lock(commit):
+            path = self.worktrees.get(commit)
+            if path is not None and path.exists():
+                self.idle.pop(commit, None)
                 self.ref_counts[commit] += 1
-                return self.worktrees[commit]
+                return path
 
-            path = self.base / f"worktree_{commit}"
+            path = self._checkout(commit)
             self.worktrees[commit] = path
             self.ref_counts[commit] = 1  # first use
+            return path
 
-        # Outside lock: create the worktree
-        repo = Repo(self.origin_repo_path)
+    def _checkout(self, commit: str) -> Path:
+        path = self.base / f"worktree_{commit}"
+        repo = self.repo
         try:
             repo.git.worktree("prune")
         except GitCommandError:
@@ -167,22 +196,38 @@ class WorktreeManager:
         return path
 
     async def release(self, commit: str):
-        async with self.lock:
+        """Drop one reference; the last holder parks the tree in the idle LRU instead of deleting it."""
+        async with self._commit_lock(commit):
             if commit not in self.ref_counts:
                 print(f"⚠️ Attempted to release untracked worktree {commit}")
                 return
             self.ref_counts[commit] -= 1
-            if self.ref_counts[commit] <= 0:
-                path = self.worktrees.get(commit)
-                if path and path.exists():
-                    shutil.rmtree(path)
+            if self.ref_counts[commit] > 0:
+                return
+            self.ref_counts.pop(commit, None)
+            self.idle[commit] = self.worktrees[commit]
+        await self._evict_idle(self.max_idle)
+
+    async def _evict_idle(self, keep: int):
+        while len(self.idle) > keep:
+            commit = next(iter(self.idle))
+            async with self._commit_lock(commit):
+                path = self.idle.pop(commit, None)
+                if path is None or self.ref_counts.get(commit):
+                    continue  # re-acquired while we waited
                 self.worktrees.pop(commit, None)
-                self.ref_counts.pop(commit, None)
+                self._forget_hierarchy(commit)
+                if path.exists():
+                    shutil.rmtree(path)
+
+    async def close(self):
+        """Remove every idle worktree; call once the run is finished."""
+        await self._evict_idle(0)
 
     def create(self, commit: str) -> Path:
         worktree_path = self.base / f"worktree_{commit}"
         self.worktrees[commit] = worktree_path
-        repo = Repo(self.origin_repo_path)
+        repo = self.repo
 
         # 1) prune any broken entries
         try:
@@ -235,13 +280,20 @@ class WorktreeManager:
         if not Path(worktree_path).exists():
             raise FileNotFoundError(f"❌ Worktree path does not exist: {worktree_path}")
 
-        hierarchy = generate_file_tree(worktree_path, max_depth=3)
-        return hierarchy
+        key = (worktree_id, max_depth)
+        if key not in self.hierarchy_cache:   # same commit -> same tree, walk it once
+            self.hierarchy_cache[key] = generate_file_tree(worktree_path, max_depth=max_depth)
+        return self.hierarchy_cache[key]
+
+    def _forget_hierarchy(self, commit: str):
+        for key in [k for k in self.hierarchy_cache if k[0] == commit]:
+            del self.hierarchy_cache[key]
     
     def down(self, worktree_id: str):
         worktree_path = self.worktrees[worktree_id]
         shutil.rmtree(worktree_path)
         del self.worktrees[worktree_id]
+        self._forget_hierarchy(worktree_id)
 
 
 
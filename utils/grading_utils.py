@@ -0,0 +1,92 @@
+import asyncio
+import shutil
+import tempfile
+import time
+import traceback
+from pathlib import Path
+
+import orjson
+
+from utils.jsonl_utils import load_jsonl
+
+ERR_FILE = Path("logs/grade_agent_answer_errors.log")   # main() points it next to the run's output
+
+
+def set_err_file(path: Path):
+    global ERR_FILE
+    ERR_FILE = path
+
+
+def dump_line(record: dict) -> bytes:
+    # OPT_NON_STR_KEYS: tool inputs/outputs can carry int-keyed dicts
+    return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS)
+
+
+def log_err(msg: str, exc: Exception | None = None):
+    # only ever called from the event-loop thread, so no lock: the entry is built
+    # first and appended with a single write
+    entry = f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {msg}\n"
+    if exc:
+        entry += "".join(traceback.format_exception(exc))
+    with ERR_FILE.open("a") as fh:
+        fh.write(entry + "-"*60 + "\n")
+
+
+def grade_inputs(row: dict, rubric_json: str) -> tuple[str, ...]:
+    # everything a grade depends on: the prompt inputs plus what the tools read
+    # (the commit's worktree and this PR's own diff / changed files)
+    return (row["commit_hash"], rubric_json, row["question"], row["answer"],
+            row["diff"], orjson.dumps(row["changed_files"]).decode())
+
+
+def format_grades(gr) -> str:
+    return "\n".join(f"{c.score}\t{c.name}" for c in gr.graded_criteria)
+
+
+async def filter_and_clean_graded_rubrics(
+    output_path: Path, cleaned_path: Path
+) -> tuple[set, set]:
+    """
+    Create a cleaned output by filtering out failed graded rubrics.
+    Merges with previously successful entries in `cleaned_path` if it exists.
+    Returns (failed PR numbers, PR numbers left in the cleaned file).
+    """
+    failed_pr_numbers = set()
+    entries_to_keep = {}
+
+    # Load new graded results and track failures
+    graded = await asyncio.to_thread(load_jsonl, output_path)
+    for entry in graded:
+        pr = entry["pr_number"]
+        if entry.get("score_percent") == "Failed to grade":
+            failed_pr_numbers.add(pr)
+        else:
+            entries_to_keep[pr] = entry
+
+    # Merge in previously successful entries from cleaned_path if it exists
+    # (skipped when cleaning in place: that file was just read above)
+    if cleaned_path != output_path and cleaned_path.exists():
+        for entry in await asyncio.to_thread(load_jsonl, cleaned_path):
+            pr = entry["pr_number"]
+            if pr not in failed_pr_numbers:
+                entries_to_keep[pr] = entry  # don't overwrite with failure
+
+    print(f"❌ Failed to grade: {len(failed_pr_numbers)} PRs")
+    print(f"✅ Total entries to keep: {len(entries_to_keep)}")
+
+    # in-place clean of a file with no failures and no duplicate rows: nothing to rewrite
+    if cleaned_path == output_path and not failed_pr_numbers and len(graded) == len(entries_to_keep):
+        print(f"✅ {cleaned_path} is already clean")
+        return failed_pr_numbers, set(entries_to_keep)
+
+    # Write to a temporary file to allow safe overwrite
+    with tempfile.NamedTemporaryFile("w", delete=False, dir=cleaned_path.parent, suffix=".jsonl") as tmp_f:
+        tmp_path = Path(tmp_f.name)
+
+    await asyncio.to_thread(
+        tmp_path.write_bytes, b"".join(dump_line(entry) for entry in entries_to_keep.values())
+    )
+
+    shutil.move(tmp_path, cleaned_path)
+    print(f"✅ Cleaned file written to {cleaned_path}")
+    return failed_pr_numbers, set(entries_to_keep)
@@ -14,6 +14,8 @@ from langchain_anthropic import ChatAnthropic
 from langchain_core.prompts import ChatPromptTemplate
 import asyncio
 import os
+import re
+import orjson
 
 def clean_json(input_path: Path, output_path: Path) -> None:
     """
@@ -49,6 +51,62 @@ def clean_json(input_path: Path, output_path: Path) -> None:
             json.dump(obj, outfile)
             outfile.write("\n")
 
+# ---------- deterministic repair (no LLM) ----------
+TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+def outermost_json_object(raw: str) -> str | None:
+    """
+    First balanced {...} in `raw`. Tracks strings and escapes, so braces inside
+    values (code snippets in justifications) don't throw the count off.
+    """
+    start = raw.find("{")
+    if start < 0:
+        return None
+    depth, in_str, escaped = 0, False, False
+    for i in range(start, len(raw)):
+        c = raw[i]
+        if in_str:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_str = False
+        elif c == '"':
+            in_str = True
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return raw[start : i + 1]
+    return None
+
+def restore_prefilled_brace(raw: str) -> str:
+    """Put back the '{' a prompt prefilled when the output starts at a key; anything else is returned as is."""
+    return "{" + raw if raw.lstrip().startswith('"') else raw
+
+def fast_repair_json(raw: str) -> dict | None:
+    """
+    Cheap fixes for near-valid model JSON, tried before any LLM-backed repair:
+    the outermost object, then the same with trailing commas dropped. Output that
+    starts at a key ('"name": ...') lost its prefilled '{', so that is restored first.
+    Returns None when none of them parse.
+    """
+    texts = ("{" + raw, raw) if raw.lstrip().startswith('"') else (raw,)
+    for text in texts:
+        candidate = outermost_json_object(text)
+        if candidate is None:
+            continue
+        for attempt in (candidate, TRAILING_COMMA_RE.sub(r"\1", candidate)):
+            try:
+                data = orjson.loads(attempt)
+            except orjson.JSONDecodeError:
+                continue
+            if isinstance(data, dict):
+                return data
+    return None
+
 # ✅ Decorator factory
 def retry_with_exponential_backoff(
     initial_delay: float = 1,
@@ -82,17 +140,20 @@ class JSONRepairAgent():
     def __init__(self, model_name: str = "gpt-4.1-mini"):
         load_dotenv()
         self.llm = ChatOpenAI(model_name=model_name, temperature=0.0)
+        self.fixers = {}    # schema -> OutputFixingParser, built on first use
 
     def repair_json_output(self, raw_output: str, schema_model: Type[BaseModel]) -> BaseModel:
         """
         Attempts to parse and repair a JSON output to match the provided Pydantic schema.
         """
-
-        self.parser = PydanticOutputParser(pydantic_object=schema_model)
+        if schema_model not in self.fixers:
+            parser = PydanticOutputParser(pydantic_object=schema_model)
+            self.fixers[schema_model] = OutputFixingParser.from_llm(llm=self.llm, parser=parser, max_retries=0)
+        fixer = self.fixers[schema_model]
 
         @retry_with_exponential_backoff()
         def parse_with_backoff(output: str):
-            return OutputFixingParser.from_llm(llm=self.llm, parser=self.parser, max_retries=0).parse(output)
+            return fixer.parse(output)
         
         return parse_with_backoff(raw_output)
     
@@ -105,12 +166,12 @@ class ClaudeJSONRepairAgent():
             timeout=None,
             stop=None,
         )
+        self.chains = {}    # schema -> prompt | llm | fixing parser, built on first use
+
+    def _chain(self, schema_model: Type[BaseModel]):
+        if schema_model in self.chains:
+            return self.chains[schema_model]
 
-    async def repair_json_output(self, raw_output: str, schema_model: Type[BaseModel]) -> BaseModel:
-        """
-        Attempts to parse and repair a JSON output to match the provided Pydantic schema.
-        """
-        
         parser = PydanticOutputParser(pydantic_object=schema_model)
         
         system_prompt = """
@@ -118,7 +179,8 @@ class ClaudeJSONRepairAgent():
         You need to repair or extract the JSON output to match the Pydantic schema.
         """
 
-        user_prompt = f"""
+        # raw_output is a template variable, so braces in the broken JSON are not parsed as fields
+        user_prompt = """
         JSON output: {raw_output}
         """
         
@@ -133,6 +195,14 @@ class ClaudeJSONRepairAgent():
         )
 
         chain = prompt | self.llm | OutputFixingParser.from_llm(llm=self.llm, parser=parser, max_retries=2)
+        self.chains[schema_model] = chain
+        return chain
+
+    async def repair_json_output(self, raw_output: str, schema_model: Type[BaseModel]) -> BaseModel:
+        """
+        Attempts to parse and repair a JSON output to match the provided Pydantic schema.
+        """
+        chain = self._chain(schema_model)
         fixed_model: BaseModel = await chain.ainvoke({"raw_output": raw_output})  # this returns the parsed BaseModel
         
         return fixed_model
@@ -0,0 +1,183 @@
+import asyncio
+import mmap
+import os
+import orjson
+import queue
+import re
+import threading
+import time
+from itertools import islice
+from pathlib import Path
+
+WRITE_BUFFER_SIZE = 1 << 20  # 1MB userspace buffer
+MAX_BATCH = 256              # max lines per write() call
+FLUSH_INTERVAL = 5.0         # seconds between flushes; close() always flushes
+READ_BUFFER_SIZE = 1 << 20   # 1MB read buffer for bulk loads
+
+# first "pr_number" key on a line; quotes inside string values are escaped, so this only hits keys
+PR_NUMBER_RE = re.compile(rb'"pr_number":\s*(\d+)')
+
+# pr_number ... answer on one line; group 2 only matches an answer that is exactly "(no content)"
+ANSWERED_RE = re.compile(rb'"pr_number":\s*(\d+)[^\n]*"answer":\s*"(\(no content\)")?')
+
+
+class JsonlWriter:
+    """
+    Appends already-serialised JSONL lines (bytes) to `path` from a dedicated thread.
+    `put` never blocks on disk; `close` drains the queue and joins the thread.
+    Data is flushed and fsync'd at most every `flush_interval` seconds (and on close),
+    never per line; a crash loses at most that window, which `--resume` re-derives.
+    """
+    def __init__(self, path: str | Path, max_batch: int = MAX_BATCH,
+                 flush_interval: float = FLUSH_INTERVAL):
+        self.path = Path(path)
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.queue: queue.Queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=f"jsonl-writer:{self.path.name}", daemon=True)
+        self.thread.start()
+
+    def put(self, line: bytes):
+        self.queue.put(line)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self):
+        with open(self.path, 'ab', buffering=WRITE_BUFFER_SIZE) as f:
+            last_flush = time.monotonic()
+            dirty = False               # lines written since the last sync
+            while True:
+                try:
+                    batch = [self.queue.get(timeout=self.flush_interval)]
+                except queue.Empty:     # idle: push whatever is buffered (nothing to do if clean)
+                    if dirty:
+                        self._sync(f)
+                        dirty = False
+                    last_flush = time.monotonic()
+                    continue
+                while len(batch) < self.max_batch and batch[-1] is not None:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                done = batch[-1] is None
+                if done:
+                    batch.pop()
+                if batch:
+                    f.write(b"".join(batch))
+                    dirty = True
+                if done:
+                    if dirty:
+                        self._sync(f)
+                    return
+                if dirty and time.monotonic() - last_flush >= self.flush_interval:
+                    self._sync(f)
+                    dirty = False
+                    last_flush = time.monotonic()
+
+    @staticmethod
+    def _sync(f):
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def scan_answered_prs(path: str | Path) -> set[int]:
+    """
+    PR numbers in an answers JSONL whose answer isn't "(no content)".
+    Regex over an mmap of the file, so no per-line JSON decode on resume.
+    """
+    path = Path(path)
+    if path.stat().st_size == 0:
+        return set()
+    answered: set[int] = set()
+    with path.open('rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for m in ANSWERED_RE.finditer(mm):
+            if m.group(2) is None:
+                answered.add(int(m.group(1)))
+    return answered
+
+
+def load_jsonl(path: str | Path) -> list[dict]:
+    """
+    Read a whole JSONL file in one go (blank lines skipped). Sync on purpose:
+    call it via `asyncio.to_thread` instead of paying a thread hop per line.
+    """
+    with open(path, 'rb', buffering=READ_BUFFER_SIZE) as f:
+        return [orjson.loads(line) for line in f if line.strip()]
+
+
+def index_jsonl(path: str | Path, keep: set | None = None) -> dict:
+    """
+    Stream a JSONL file into {pr_number: record}, one line at a time (no whole-file string
+    or line list). With `keep`, records for other PRs are dropped as they are read.
+    """
+    index = {}
+    with open(path, 'rb', buffering=READ_BUFFER_SIZE) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if keep is not None and pr_number_of(line) not in keep:
+                continue
+            record = orjson.loads(line)
+            index[record["pr_number"]] = record
+    return index
+
+
+def pr_number_of(line: bytes):
+    """pr_number of a raw JSONL line, by regex when possible and full parse otherwise."""
+    m = PR_NUMBER_RE.search(line)
+    return int(m.group(1)) if m else orjson.loads(line).get("pr_number")
+
+
+def iter_jsonl_lines(path: str | Path):
+    """Stream raw, newline-terminated JSONL lines (blank lines skipped)."""
+    with open(path, 'rb', buffering=READ_BUFFER_SIZE) as f:
+        for line in f:
+            if line.strip():
+                yield line if line.endswith(b"\n") else line + b"\n"
+
+
+def drop_prs_from_jsonl(path: str | Path, drop: set):
+    """
+    Rewrite `path` without the lines whose pr_number is in `drop`, copying raw bytes
+    through a temp file that atomically replaces the original.
+    """
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, 'wb', buffering=WRITE_BUFFER_SIZE) as out:
+        if path.exists():
+            for line in iter_jsonl_lines(path):
+                if pr_number_of(line) not in drop:
+                    out.write(line)
+    os.replace(tmp, path)
+
+
+def _read_records(f, n: int) -> tuple[int, list[dict]]:
+    lines = list(islice(f, n))
+    return len(lines), [orjson.loads(line) for line in lines if line.strip()]
+
+
+async def aiter_jsonl(path: str | Path, limit: int | None = None, batch_size: int = 64):
+    """
+    Stream parsed JSONL records without loading the file: each thread hop reads and
+    parses up to `batch_size` lines. Stops after `limit` records if given.
+    """
+    remaining = limit
+    with open(path, 'rb', buffering=READ_BUFFER_SIZE) as f:
+        while remaining is None or remaining > 0:
+            n_read, records = await asyncio.to_thread(_read_records, f, batch_size)
+            if not n_read:
+                return
+            for record in records[:remaining]:
+                yield record
+            if remaining is not None:
+                remaining -= min(len(records), remaining)
@@ -0,0 +1,118 @@
+import asyncio
+import time
+from typing import Any
+import anthropic
+from langchain_core.callbacks import AsyncCallbackHandler
+
+CHARS_PER_TOKEN = 4  # rough estimate, good enough for pacing
+RETRYABLE_STATUS = {429, 500, 502, 503, 529}  # rate limited / transient server side / overloaded
+
+
+class TokenBucketLimiter:
+    """
+    Proactive requests/min + tokens/min gate. Buckets refill continuously
+    (computed lazily on acquire, so no background task); either limit may be None.
+    """
+    def __init__(self, requests_per_min: float | None = None, tokens_per_min: float | None = None):
+        self.rpm = requests_per_min
+        self.tpm = tokens_per_min
+        self.req_budget = requests_per_min or 0.0
+        self.tok_budget = tokens_per_min or 0.0
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()  # waiters are served FIFO
+
+    def _refill(self):
+        now = time.monotonic()
+        dt, self.last = now - self.last, now
+        if self.rpm:
+            self.req_budget = min(self.rpm, self.req_budget + dt * self.rpm / 60)
+        if self.tpm:
+            self.tok_budget = min(self.tpm, self.tok_budget + dt * self.tpm / 60)
+
+    async def acquire(self, tokens: int = 0):
+        if self.tpm:
+            tokens = min(tokens, self.tpm)  # an oversized request still gets through once the bucket is full
+        async with self.lock:
+            while True:
+                self._refill()
+                wait = 0.0
+                if self.rpm and self.req_budget < 1:
+                    wait = max(wait, (1 - self.req_budget) * 60 / self.rpm)
+                if self.tpm and self.tok_budget < tokens:
+                    wait = max(wait, (tokens - self.tok_budget) * 60 / self.tpm)
+                if wait == 0.0:
+                    if self.rpm:
+                        self.req_budget -= 1
+                    if self.tpm:
+                        self.tok_budget -= tokens
+                    return
+                await asyncio.sleep(wait)
+
+
+class RateLimitGate:
+    """
+    Shared 429 cooldown: once any request is told to back off (retry-after), every
+    other request waits at the gate until that time has passed, instead of each
+    worker discovering the limit with its own failed call.
+    """
+    def __init__(self):
+        self.open = asyncio.Event()
+        self.open.set()
+        self.reopen_at = 0.0
+
+    async def wait(self):
+        await self.open.wait()
+
+    def trip(self, seconds: float):
+        reopen_at = time.monotonic() + seconds
+        if reopen_at <= self.reopen_at:
+            return                      # already closed for at least that long
+        self.reopen_at = reopen_at
+        self.open.clear()
+        asyncio.get_running_loop().call_later(seconds, self._reopen, reopen_at)
+
+    def _reopen(self, reopen_at: float):
+        if reopen_at == self.reopen_at:     # otherwise a later trip extended the cooldown
+            self.open.set()
+
+    def retryable(self, e: BaseException) -> bool:
+        """Retry predicate for `retry_with_backoff` that also closes the gate on a 429."""
+        if (delay := retry_after(e)) is not None:
+            self.trip(delay)
+        return is_retryable(e)
+
+
+class RateLimitCallback(AsyncCallbackHandler):
+    """
+    Attach to a chat model (`callbacks=[...]`) so every LLM request, including each
+    step of an agent's tool loop, waits on the cooldown gate and/or limiter before it is sent.
+    """
+    raise_error = True
+
+    def __init__(self, limiter: TokenBucketLimiter | None = None, gate: RateLimitGate | None = None):
+        self.limiter = limiter
+        self.gate = gate
+
+    async def on_chat_model_start(self, serialized: dict, messages: list[list[Any]], **kwargs):
+        if self.gate is not None:
+            await self.gate.wait()
+        if self.limiter is not None:
+            chars = sum(len(str(m.content)) for batch in messages for m in batch)
+            await self.limiter.acquire(chars // CHARS_PER_TOKEN)
+
+
+def is_retryable(e: BaseException) -> bool:
+    """Rate limits, overloads, 5xx and dropped connections are worth retrying; auth/4xx are not."""
+    if isinstance(e, anthropic.APIConnectionError):     # includes timeouts
+        return True
+    return isinstance(e, anthropic.APIStatusError) and e.status_code in RETRYABLE_STATUS
+
+
+def retry_after(e: BaseException) -> float | None:
+    """Seconds from a 429's retry-after header, if the server sent one."""
+    if not isinstance(e, anthropic.RateLimitError):
+        return None
+    try:
+        return float(e.response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
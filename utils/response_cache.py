@@ -0,0 +1,52 @@
+import hashlib
+import sqlite3
+import time
+from pathlib import Path
+
+import orjson
+
+COMMIT_EVERY = 64           # sets per commit; close() always commits
+COMMIT_INTERVAL = 5.0       # ...or seconds since the last commit, whichever comes first
+
+
+def cache_key(*parts: str) -> str:
+    """sha256 over everything that determines an LLM result (model, prompt inputs, ...)."""
+    return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Exact-match on-disk cache of finished LLM results (any JSON-able dict), one sqlite
+    file shared across runs. Called straight from the event loop, so nothing here may
+    block on disk per call: reads hit the page cache, and writes go into an open
+    transaction (WAL, synchronous=NORMAL) that is committed every COMMIT_EVERY sets or
+    COMMIT_INTERVAL seconds and on close. A crash loses at most that window.
+    """
+    def __init__(self, path: str | Path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value BLOB)")
+        self.conn.commit()
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+    def get(self, key: str) -> dict | None:
+        # same connection, so uncommitted sets are already visible
+        row = self.conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+        return orjson.loads(row[0]) if row else None
+
+    def set(self, key: str, value: dict):
+        self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?)", (key, orjson.dumps(value)))
+        self.pending += 1
+        if self.pending >= COMMIT_EVERY or time.monotonic() - self.last_commit >= COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+    def close(self):
+        self.commit()
+        self.conn.close()